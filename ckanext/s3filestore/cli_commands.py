@@ -1,15 +1,41 @@
 # encoding: utf-8
 
-from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import datetime
+from itertools import groupby
+import mimetypes
+from operator import itemgetter
 import os
+import six
 import sys
+import time
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
-from ckan.lib import munge
-from ckan.plugins.toolkit import config, get_action, ValidationError
+from ckan import model
+from ckan.lib import munge, search
+from ckan.plugins.toolkit import config, get_action
 from ckanext.s3filestore import uploader
-from ckanext.s3filestore.uploader import get_s3_session, S3FileStoreException
+from ckanext.s3filestore.multipart import MB
+from ckanext.s3filestore.uploader import S3FileStoreException, PUBLIC_ACL, PRIVATE_ACL, \
+    DELETE_OBJECTS_BATCH_SIZE, VISIBILITY_CACHE_PATH, METADATA_CACHE_PATH, _get_object_age_days
+
+# how many datasets to reconcile at a time in bulk visibility updates
+BULK_VISIBILITY_CHUNK_SIZE = 100
+DEFAULT_MIGRATION_WORKERS = 8
+# how many resources to look up per database query
+RESOURCE_QUERY_CHUNK_SIZE = 1000
+# above this many resource directories, list the whole resources
+# directory once instead of each resource directory
+MAX_LISTED_DIRECTORIES = 20
+# seconds between progress reports
+PROGRESS_INTERVAL = 10
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+DELETED = 'deleted'
+RETAINED = 'retained'
 
 
 class DBConnection:
@@ -56,7 +82,7 @@ class S3FilestoreCommands():
 
         print('Configuration OK!')
 
-    def upload_all(self):
+    def upload_all(self, workers=DEFAULT_MIGRATION_WORKERS, checkpoint=None, verify_size=False):
         BASE_PATH = config.get('ckan.storage_path', '/var/lib/ckan/default/resources')
         resource_ids_and_paths = {}
 
@@ -70,44 +96,44 @@ class S3FilestoreCommands():
 
         with DBConnection(config) as connection:
             resource_ids_and_names = {}
+            resource_privacy = {}
 
-            for resource_id, file_path in resource_ids_and_paths.iteritems():
-                resource = connection.execute(text('''
-                    SELECT id, url
-                    FROM resource
-                    WHERE id = :id
-                    AND state = 'active'
-                    AND url IS NOT NULL
-                    AND url <> ''
-                    AND url_type = 'upload'
-                '''), id=resource_id)
-                if resource.rowcount:
-                    _id, url = resource.first()
-                    file_name = url.split('/')[-1] if '/' in url else url
-                    resource_ids_and_names[_id] = file_name.lower()
-                else:
-                    print("{} is an orphan; no resource points to it".format(file_path))
+            for _id, url, package_id, private in _select_resources_in_chunks(
+                    connection, 'id', list(resource_ids_and_paths.keys()), uploads_only=True):
+                file_name = url.split('/')[-1] if '/' in url else url
+                resource_ids_and_names[_id] = file_name.lower()
+                resource_privacy[_id] = private
+
+        for resource_id, file_path in six.iteritems(resource_ids_and_paths):
+            if resource_id not in resource_ids_and_names:
+                print("{} is an orphan; no resource points to it".format(file_path))
 
         print('{0} resources matched on the database'.format(
             len(resource_ids_and_names.keys())))
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths,
+                            resource_privacy=resource_privacy,
+                            workers=workers, checkpoint=checkpoint, verify_size=verify_size,
+                            bucket_sweep=True)
 
-    def upload_single(self, id):
+    def upload_single(self, id, workers=DEFAULT_MIGRATION_WORKERS, checkpoint=None, verify_size=False):
         with DBConnection(config) as connection:
             resource_ids_and_names = {}
+            resource_privacy = {}
             for resource in connection.execute(text('''
-                    SELECT id, url
+                    SELECT resource.id, resource.url, package.private
                     FROM resource
-                    WHERE (id = :id or package_id = :id)
-                    AND state = 'active'
-                    AND url IS NOT NULL
-                    AND url <> ''
-                    AND url_type = 'upload'
+                    JOIN package ON package.id = resource.package_id
+                    WHERE (resource.id = :id or resource.package_id = :id)
+                    AND resource.state = 'active'
+                    AND resource.url IS NOT NULL
+                    AND resource.url <> ''
+                    AND resource.url_type = 'upload'
             '''), id=id):
-                _id, url = resource
+                _id, url, private = resource
                 file_name = url.split('/')[-1] if '/' in url else url
                 resource_ids_and_names[_id] = file_name.lower()
+                resource_privacy[_id] = private
 
         print('{0} resources matched on the database'.format(
             len(resource_ids_and_names.keys())))
@@ -124,9 +150,11 @@ class S3FilestoreCommands():
         print('Found {0} resource files in the file system'.format(
             len(resource_ids_and_paths.keys())))
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths,
+                            resource_privacy=resource_privacy,
+                            workers=workers, checkpoint=checkpoint, verify_size=verify_size)
 
-    def upload_pairtree(self):
+    def upload_pairtree(self, workers=DEFAULT_MIGRATION_WORKERS, checkpoint=None, verify_size=False):
         def _to_pairtree_path(path):
             return os.path.join(*[path[i:i + 2] for i in range(0, len(path), 2)])
 
@@ -150,42 +178,47 @@ class S3FilestoreCommands():
             len(resource_paths)))
 
         # match files to resource URLs
+        SITE_URL = config.get('ckan.site_url')
+        BASE_URL = SITE_URL + '/storage/f/'
+        pairtree_urls = {BASE_URL + file_path.replace(':', '%3A'): file_path
+                         for file_path in resource_paths}
         with DBConnection(config) as connection:
             resource_ids_and_names = {}
+            resource_privacy = {}
+            matched_paths = set()
 
-            SITE_URL = config.get('ckan.site_url')
-            BASE_URL = SITE_URL + '/storage/f/'
-            for file_path in resource_paths:
-                pairtree_url = BASE_URL + file_path.replace(':', '%3A')
-                resource = connection.execute(text('''
-                    SELECT id, url
-                    FROM resource
-                    WHERE url = :url
-                    AND state = 'active'
-                    AND url IS NOT NULL
-                    AND url <> ''
-                '''), url=pairtree_url)
-                if resource.rowcount:
-                    _id, url = resource.first()
-                    if url:
-                        file_name = url.split('/')[-1] if '/' in url else url
-                        resource_ids_and_names[_id] = file_name.lower()
-                        resource_ids_and_paths[_id] = BASE_PATH + '/' + file_path
-                else:
-                    print("{} is an orphan; no resource points to it".format(file_path))
+            for _id, url, package_id, private in _select_resources_in_chunks(
+                    connection, 'url', list(pairtree_urls.keys())):
+                file_path = pairtree_urls[url]
+                file_name = url.split('/')[-1] if '/' in url else url
+                resource_ids_and_names[_id] = file_name.lower()
+                resource_ids_and_paths[_id] = BASE_PATH + '/' + file_path
+                resource_privacy[_id] = private
+                matched_paths.add(file_path)
+
+        for file_path in resource_paths:
+            if file_path not in matched_paths:
+                print("{} is an orphan; no resource points to it".format(file_path))
 
         resource_count = len(resource_ids_and_names.keys())
         print('{0} resources matched on the database'.format(resource_count))
         if resource_count == 0:
             return
 
-        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths)
+        _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths,
+                            resource_privacy=resource_privacy,
+                            workers=workers, checkpoint=checkpoint, verify_size=verify_size,
+                            bucket_sweep=True)
 
-    def update_all_visibility(self):
+    def update_all_visibility(self, direct=False, dry_run=False, checkpoint=None):
         if config.get('ckanext.s3filestore.acl', None) != 'auto':
             print("ckanext.s3filestore.acl must be set to 'auto' to execute update_all_visibility")
             return
 
+        if direct:
+            self._update_all_visibility_direct(dry_run, checkpoint)
+            return
+
         print("Updating the visibility of all datasets")
 
         packages_ids = []
@@ -214,40 +247,520 @@ class S3FilestoreCommands():
             except Exception as e:
                 print("Unable to package_patch on package_id '{}', exception {} ".format(package_id, e))
 
+    def _update_all_visibility_direct(self, dry_run=False, checkpoint=None):
+        ''' Update S3 object ACLs to match their datasets directly,
+        without patching the datasets, so that no revisions, search
+        index updates or plugin hooks are triggered.
 
-def _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths):
-    AWS_BUCKET_NAME = config.get('ckanext.s3filestore.aws_bucket_name')
-    AWS_S3_ACL = config.get('ckanext.s3filestore.acl', 'public-read')
-    s3_connection = get_s3_session(config).client('s3')
-
-    context = {'ignore_auth': True}
-    uploaded_resources = []
-    for resource_id, file_name in resource_ids_and_names.iteritems():
-        file_name = munge.munge_filename(file_name)
-        key = 'resources/{resource_id}/{file_name}'.format(
-            resource_id=resource_id, file_name=file_name)
+        If 'checkpoint' is a file path, the IDs of datasets that have
+        been completed are appended to it, and datasets already listed
+        there are skipped, so an interrupted run can be resumed.
+        '''
+        print("Updating the visibility of all datasets directly{}".format(
+            " (dry run)" if dry_run else ""))
 
+        with DBConnection(config) as connection:
+            rows = connection.execute(text('''
+                    SELECT resource.package_id, package.private, resource.id, resource.url
+                    FROM resource
+                    JOIN package ON package.id = resource.package_id
+                    WHERE resource.state = 'active'
+                    AND resource.url IS NOT NULL
+                    AND resource.url <> ''
+                    AND resource.url_type = 'upload'
+                    ORDER BY resource.package_id
+                ''')).fetchall()
+
+        if not rows:
+            print("No resources found to make visible")
+            return
+        completed = _read_checkpoint(checkpoint)
+        packages = [
+            (package_id, [(resource_id, url, private) for _, private, resource_id, url in package_rows])
+            for package_id, package_rows in groupby(rows, key=itemgetter(0))
+            if package_id not in completed
+        ]
+        if not packages:
+            print("All datasets are already recorded as completed in {}".format(checkpoint))
+            return
+        print("Found {} datasets to update, {} already completed".format(
+            len(packages), len(completed)))
+
+        resource_uploader = uploader.S3ResourceUploader({'url': ''})
+        totals = Counter()
+        failed_packages = []
+        for start in range(0, len(packages), BULK_VISIBILITY_CHUNK_SIZE):
+            chunk = packages[start:start + BULK_VISIBILITY_CHUNK_SIZE]
+            targets = [
+                ({'id': resource_id, 'url': url}, PRIVATE_ACL if private else PUBLIC_ACL)
+                for package_id, resources in chunk
+                for resource_id, url, private in resources
+            ]
+            actions, failed = resource_uploader.update_resources_visibility(targets, dry_run=dry_run)
+            totals.update(actions)
+
+            chunk_completed = []
+            for package_id, resources in chunk:
+                if failed.intersection(resource_id for resource_id, _, _ in resources):
+                    failed_packages.append(package_id)
+                else:
+                    chunk_completed.append(package_id)
+            if not dry_run:
+                _write_checkpoint(checkpoint, chunk_completed)
+            print("Processed {} of {} datasets: {}".format(
+                min(start + BULK_VISIBILITY_CHUNK_SIZE, len(packages)), len(packages), dict(totals)))
+
+        if failed_packages:
+            print("Unable to update visibility for {} datasets: {}".format(
+                len(failed_packages), ', '.join(failed_packages)))
+        print("Done{}: {}".format(" (dry run)" if dry_run else "", dict(totals)))
+
+    def purge_non_current(self, days=None, workers=DEFAULT_MIGRATION_WORKERS, dry_run=False, rate_limit=0):
+        if days is None:
+            days = int(config.get('ckanext.s3filestore.delete_non_current_days', '-1'))
+        if days < 0:
+            print("Specify --days, or set ckanext.s3filestore.delete_non_current_days")
+            sys.exit(1)
+        with DBConnection(config) as connection:
+            NonCurrentPurge(days, workers=workers, dry_run=dry_run, rate_limit=rate_limit).run(connection)
+
+
+def _read_checkpoint(checkpoint):
+    ''' Read the set of completed IDs from a checkpoint file, if any.
+    '''
+    if not checkpoint or not os.path.isfile(checkpoint):
+        return set()
+    with open(checkpoint) as checkpoint_file:
+        return set(line.strip() for line in checkpoint_file if line.strip())
+
+
+def _write_checkpoint(checkpoint, completed_ids):
+    ''' Append completed IDs to a checkpoint file, if specified.
+    '''
+    if not checkpoint or not completed_ids:
+        return
+    with open(checkpoint, 'a') as checkpoint_file:
+        for completed_id in completed_ids:
+            checkpoint_file.write(completed_id + '\n')
+
+
+def _select_resources_in_chunks(connection, column, values, uploads_only=False):
+    ''' Look up the active resources whose `column` (either 'id' or 'url')
+    matches any of `values`, with a query per chunk of values rather
+    than per value.
+
+    Generates tuples of (id, url, package_id, package private flag).
+    '''
+    conditions = "AND resource.url_type = 'upload'" if uploads_only else ""
+    query = text('''
+        SELECT resource.id, resource.url, resource.package_id, package.private
+        FROM resource
+        JOIN package ON package.id = resource.package_id
+        WHERE resource.{column} = ANY(:values)
+        AND resource.state = 'active'
+        AND resource.url IS NOT NULL
+        AND resource.url <> ''
+        {conditions}
+    '''.format(column=column, conditions=conditions))
+    for start in range(0, len(values), RESOURCE_QUERY_CHUNK_SIZE):
+        for row in connection.execute(query, values=values[start:start + RESOURCE_QUERY_CHUNK_SIZE]):
+            yield tuple(row)
+
+
+class FilestoreMigration(object):
+    ''' Copies resource files from the local filestore to S3.
+
+    Files are streamed in binary mode, as multipart uploads if they are
+    large, on a pool of worker threads. Progress, throughput and an
+    estimated time to completion are printed as the migration runs.
+
+    If 'checkpoint' is a file path, the IDs of resources that have been
+    uploaded (or found to be already present) are appended to it, and
+    resources already listed there are skipped without checking S3,
+    so an interrupted migration can be resumed.
+
+    If the ACL config is 'auto', 'resource_privacy' should map resource
+    IDs to the private flag of their packages; resources not found
+    there are looked up through the action API.
+
+    Keys that already exist are found by listing objects, rather than
+    checking each file individually. If 'bucket_sweep' is True, or the
+    files belong to more than MAX_LISTED_DIRECTORIES resources, the
+    resources directory is listed once, which suits migrating the entire
+    filestore; otherwise, only the directory of each resource is listed.
+    If 'verify_size' is True, existing keys whose size differs from
+    the local file are uploaded again.
+
+    Cache entries for uploaded keys are discarded in one batch per
+    progress report, rather than one Redis round trip (and one
+    invalidation message to every web process) per file.
+    '''
+
+    def __init__(self, workers=DEFAULT_MIGRATION_WORKERS, checkpoint=None, verify_size=False,
+                 bucket_sweep=False):
+        self.workers = max(workers, 1)
+        self.checkpoint = checkpoint
+        self.verify_size = verify_size
+        self.bucket_sweep = bucket_sweep
+        self.resource_uploader = uploader.S3ResourceUploader({'url': ''})
+        self.client = self.resource_uploader.get_s3_client()
+        self.bucket_name = self.resource_uploader.bucket_name
+        self.acl = config.get('ckanext.s3filestore.acl', PUBLIC_ACL)
+        self.counts = Counter()
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.files_total = 0
+        self._future_ids = {}
+        self._cache = self.resource_uploader.redis.batch()
+        self._resource_urls = {}
+
+    def run(self, resource_ids_and_names, resource_ids_and_paths, resource_privacy=None):
+        completed = _read_checkpoint(self.checkpoint)
+        resource_ids = [resource_id for resource_id in resource_ids_and_names
+                        if resource_id in resource_ids_and_paths and resource_id not in completed]
+        if completed:
+            print('Skipping {0} resources already recorded in {1}'.format(
+                len(completed.intersection(resource_ids_and_names)), self.checkpoint))
+        file_sizes = {resource_id: _get_file_size(resource_ids_and_paths[resource_id])
+                      for resource_id in resource_ids}
+        keys = {resource_id: self.resource_uploader.get_path(
+            resource_id, munge.munge_filename(resource_ids_and_names[resource_id]))
+            for resource_id in resource_ids}
+        existing_sizes = self._get_existing_sizes(set(keys.values()))
+        skipped_ids = set(
+            resource_id for resource_id in resource_ids if keys[resource_id] in existing_sizes
+            and (not self.verify_size or existing_sizes[keys[resource_id]] == file_sizes[resource_id]))
+        # only count what will actually be transferred, so the rate is accurate
+        self.bytes_total = sum(file_sizes[resource_id] for resource_id in resource_ids
+                               if resource_id not in skipped_ids)
+        self.files_total = len(resource_ids)
+        self.start_time = time.time()
+
+        newly_completed = []
+        last_report = self.start_time
+        executor = ThreadPoolExecutor(max_workers=self.workers)
         try:
-            s3_connection.head_object(Bucket=AWS_BUCKET_NAME, Key=key)
+            pending = set()
+            for resource_id in resource_ids:
+                file_name = munge.munge_filename(resource_ids_and_names[resource_id])
+                key = keys[resource_id]
+                if resource_id in skipped_ids:
+                    newly_completed.extend(self._record_result(
+                        resource_id, file_name, key, SKIPPED, file_sizes[resource_id]))
+                    continue
+                if key in existing_sizes:
+                    print("{} differs in size from the local file, uploading again".format(key))
+                acl = self.acl
+                if acl == 'auto':
+                    if resource_privacy and resource_id in resource_privacy:
+                        acl = PRIVATE_ACL if resource_privacy[resource_id] else PUBLIC_ACL
+                    else:
+                        acl = self._get_auto_acl(resource_id)
+                future = executor.submit(
+                    self._transfer, resource_id, file_name, key, resource_ids_and_paths[resource_id], acl)
+                self._future_ids[future] = resource_id
+                pending.add(future)
+                # keep a bounded number of files queued
+                while len(pending) >= self.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    newly_completed.extend(self._handle_results(done))
+                if time.time() - last_report >= PROGRESS_INTERVAL:
+                    self._report()
+                    self._flush(newly_completed)
+                    newly_completed = []
+                    last_report = time.time()
+            while pending:
+                done, pending = wait(pending, timeout=PROGRESS_INTERVAL, return_when=FIRST_COMPLETED)
+                newly_completed.extend(self._handle_results(done))
+                if time.time() - last_report >= PROGRESS_INTERVAL:
+                    self._report()
+                    self._flush(newly_completed)
+                    newly_completed = []
+                    last_report = time.time()
+        finally:
+            executor.shutdown(wait=True)
+            self._flush(newly_completed)
+        self._report()
+        print('Done, uploaded {0} resources to S3'.format(self.counts[UPLOADED]))
+
+    def _get_existing_sizes(self, keys):
+        ''' List the resource objects in the bucket, and return
+        the sizes of those among 'keys', by key.
+
+        The resources directory is listed in one sweep if 'bucket_sweep'
+        is set, or if the keys span more than MAX_LISTED_DIRECTORIES
+        resource directories; otherwise, each resource directory is
+        listed concurrently.
+        '''
+        existing_sizes = {}
+        if not keys:
+            return existing_sizes
+        prefixes = sorted(set(os.path.dirname(key) + '/' for key in keys))
+        if self.bucket_sweep or len(prefixes) > MAX_LISTED_DIRECTORIES:
+            prefixes = [self.resource_uploader.storage_path + '/']
+
+        def _list_prefix(prefix):
+            return [(s3_object['Key'], s3_object['Size'])
+                    for page in self.resource_uploader.iter_object_pages(prefix, self.client)
+                    for s3_object in page if s3_object['Key'] in keys]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for found in executor.map(_list_prefix, prefixes):
+                existing_sizes.update(found)
+        print('{0} of {1} files are already in S3'.format(len(existing_sizes), len(keys)))
+        return existing_sizes
+
+    def _transfer(self, resource_id, file_name, key, file_path, acl):
+        ''' Upload a single file. Runs on a worker thread,
+        so it must not use the CKAN database session.
+        '''
+        mime_type = mimetypes.guess_type(file_name, strict=False)[0] or 'application/octet-stream'
+        file_size = _get_file_size(file_path)
+        with open(file_path, 'rb') as upload_file, self.resource_uploader.get_upload_writer(
+                key, acl, mime_type, expected_size=file_size, client=self.client) as writer:
+            while True:
+                chunk = upload_file.read(self.resource_uploader.multipart_part_size)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        # drop anything cached about a previous object with this key
+        self._cache.delete(key, key + VISIBILITY_CACHE_PATH, key + METADATA_CACHE_PATH)
+        return resource_id, file_name, key, UPLOADED, file_size
+
+    def _get_auto_acl(self, resource_id):
+        context = {'ignore_auth': True}
+        package_id = get_action('resource_show')(context, {'id': resource_id})['package_id']
+        package = get_action('package_show')(context, {'id': package_id})
+        return PRIVATE_ACL if package['private'] else PUBLIC_ACL
+
+    def _handle_results(self, futures):
+        ''' Record finished transfers. Runs on the main thread.
+        '''
+        completed = []
+        for future in futures:
+            resource_id = self._future_ids.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                self.counts[FAILED] += 1
+                print("Failed to upload resource {0}: {1}".format(resource_id, e))
+                continue
+            completed.extend(self._record_result(*result))
+        return completed
+
+    def _record_result(self, resource_id, file_name, key, outcome, file_size):
+        self.counts[outcome] += 1
+        if outcome == SKIPPED:
             print("{} is already in S3, skipping".format(key))
-            continue
-        except ClientError:
-            upload_file = open(resource_ids_and_paths[resource_id])
-
-            acl = AWS_S3_ACL
-            if acl == 'auto':
-                package_id = get_action('resource_show')({'ignore_auth': True}, {'id': resource_id})['package_id']
-                package = get_action('package_show')({'ignore_auth': True}, {'id': package_id})
-                acl = 'private' if package['private'] else 'public-read'
-
-            print("Uploading {} to S3 bucket {} under key {} with ACL {}".format(upload_file, AWS_BUCKET_NAME, key, acl))
-            s3_connection.put_object(Bucket=AWS_BUCKET_NAME, Key=key, Body=upload_file, ACL=acl)
-            uploaded_resources.append(resource_id)
-            print('Uploaded resource {0} ({1}) to S3'.format(resource_id, file_name))
+        else:
+            self.bytes_done += file_size
+            print('Uploaded resource {0} ({1}) to S3 bucket {2} under key {3}'.format(
+                resource_id, file_name, self.bucket_name, key))
+        # files found in S3 may be from a run that stopped before this
+        self._resource_urls[resource_id] = file_name
+        return [resource_id]
+
+    def _flush(self, completed_ids):
+        ''' Send queued cache invalidations and resource URL updates,
+        then record the resources as completed in the checkpoint.
+        '''
+        self._cache.execute()
+        self._update_resource_urls()
+        _write_checkpoint(self.checkpoint, completed_ids)
+
+    def _update_resource_urls(self):
+        ''' Point resources at their files in S3, updating the database
+        directly with one query per chunk of resources, and then
+        reindexing each affected dataset once.
+
+        Unlike 'resource_patch', this does not validate the resources,
+        record activity or call plugin hooks, which would make each
+        resource a full dataset update.
+        '''
+        resource_urls, self._resource_urls = self._resource_urls, {}
+        if not resource_urls:
+            return
+        resource_ids = list(resource_urls.keys())
+        package_ids = set()
+        with DBConnection(config) as connection:
+            for start in range(0, len(resource_ids), RESOURCE_QUERY_CHUNK_SIZE):
+                with connection.begin():
+                    changed_resources = {
+                        resource_id: package_id
+                        for resource_id, url, package_id in connection.execute(text('''
+                            SELECT id, url, package_id FROM resource WHERE id = ANY(:ids)
+                        '''), ids=resource_ids[start:start + RESOURCE_QUERY_CHUNK_SIZE])
+                        if url != resource_urls[resource_id]
+                    }
+                    if not changed_resources:
+                        continue
+                    connection.execute(text('UPDATE resource SET url = :url WHERE id = :id'), [
+                        {'id': resource_id, 'url': resource_urls[resource_id]}
+                        for resource_id in changed_resources])
+                    chunk_package_ids = list(set(changed_resources.values()))
+                    connection.execute(text('''
+                        UPDATE package SET metadata_modified = :now WHERE id = ANY(:ids)
+                    '''), now=datetime.datetime.utcnow(), ids=chunk_package_ids)
+                    package_ids.update(chunk_package_ids)
+        if not package_ids:
+            return
+        # discard anything the ORM read before the update
+        model.Session.remove()
+        for package_id in package_ids:
             try:
-                get_action('resource_patch')(context, {'id': resource_id, 'url': file_name})
-            except ValidationError:
-                print("{} failed to validate; file is in S3 but might not be used".format(resource_id))
-                pass
-
-    print('Done, uploaded {0} resources to S3'.format(len(uploaded_resources)))
+                search.rebuild(package_id)
+            except Exception as e:
+                print("Failed to reindex dataset {0}: {1}".format(package_id, e))
+        print("Updated the URLs of resources in {0} datasets".format(len(package_ids)))
+
+    def _report(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        rate = self.bytes_done / elapsed
+        files_done = sum(self.counts.values())
+        if rate and self.bytes_total > self.bytes_done:
+            eta = str(datetime.timedelta(seconds=int((self.bytes_total - self.bytes_done) / rate)))
+        else:
+            eta = 'unknown' if files_done < self.files_total else '0:00:00'
+        print('Processed {0} of {1} files ({2} uploaded, {3} skipped, {4} failed); '
+              '{5:.1f} of {6:.1f} MB uploaded at {7:.2f} MB/s; ETA {8}'.format(
+                  files_done, self.files_total, self.counts[UPLOADED], self.counts[SKIPPED],
+                  self.counts[FAILED], self.bytes_done / MB, self.bytes_total / MB, rate / MB, eta))
+
+
+class NonCurrentPurge(object):
+    ''' Deletes resource uploads that are no longer current, across
+    the whole bucket, once they are at least 'days' days old.
+
+    The resources directory is listed one page at a time. Since keys
+    are listed in order, each page holds the objects of a few
+    resources together; their current URLs are looked up with one
+    query per page. Expired keys are deleted in batches of up to
+    DELETE_OBJECTS_BATCH_SIZE, on a pool of worker threads with a
+    bounded queue, so memory use does not grow with the bucket.
+
+    Objects of resources that are not active uploads are left alone.
+    If 'rate_limit' is set, at most that many objects are deleted per
+    second, on average. If 'dry_run' is True, expired objects are
+    counted but not deleted.
+    '''
+
+    def __init__(self, days, workers=DEFAULT_MIGRATION_WORKERS, dry_run=False, rate_limit=0):
+        self.days = days
+        self.workers = max(workers, 1)
+        self.dry_run = dry_run
+        self.rate_limit = rate_limit
+        self.resource_uploader = uploader.S3ResourceUploader({'url': ''})
+        self.client = self.resource_uploader.get_s3_client()
+        self.prefix = self.resource_uploader.storage_path + '/'
+        self.counts = Counter()
+        self.submitted = 0
+        self._future_keys = {}
+
+    def run(self, connection):
+        self.start_time = time.time()
+        last_report = self.start_time
+        batch = []
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            pending = set()
+            for page in self.resource_uploader.iter_object_pages(self.prefix, self.client):
+                for key in self._find_expired_keys(connection, page):
+                    batch.append(key)
+                    if len(batch) >= DELETE_OBJECTS_BATCH_SIZE:
+                        pending = self._delete(executor, pending, batch)
+                        batch = []
+                if time.time() - last_report >= PROGRESS_INTERVAL:
+                    self._report()
+                    last_report = time.time()
+            if batch:
+                pending = self._delete(executor, pending, batch)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                self._handle_results(done)
+        finally:
+            executor.shutdown(wait=True)
+        self._report()
+        print("Done{}: {}".format(" (dry run)" if self.dry_run else "", dict(self.counts)))
+
+    def _get_resource_id(self, key):
+        relative_key = key[len(self.prefix):]
+        return relative_key.split('/', 1)[0] if '/' in relative_key else None
+
+    def _find_expired_keys(self, connection, page):
+        ''' Generate the keys in a page of objects that are
+        neither current nor too recent to delete.
+        '''
+        groups = [(resource_id, list(s3_objects)) for resource_id, s3_objects in groupby(
+            page, key=lambda s3_object: self._get_resource_id(s3_object['Key']))]
+        current_keys = {
+            resource_id: self.resource_uploader.get_path(resource_id, os.path.basename(url))
+            for resource_id, url, _, _ in _select_resources_in_chunks(
+                connection, 'id', [resource_id for resource_id, _ in groups if resource_id],
+                uploads_only=True)
+        }
+        for resource_id, s3_objects in groups:
+            current_key = current_keys.get(resource_id)
+            if current_key is None:
+                self.counts[SKIPPED] += len(s3_objects)
+                continue
+            for s3_object in s3_objects:
+                if s3_object['Key'] == current_key or _get_object_age_days(s3_object) < self.days:
+                    self.counts[RETAINED] += 1
+                else:
+                    yield s3_object['Key']
+
+    def _delete(self, executor, pending, keys):
+        ''' Queue a batch of keys to be deleted, waiting if the queue
+        is full or deleting them now would exceed the rate limit.
+        '''
+        if self.dry_run:
+            self.counts[DELETED] += len(keys)
+            return pending
+        if self.rate_limit > 0:
+            delay = self.start_time + self.submitted / self.rate_limit - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.submitted += len(keys)
+        future = executor.submit(self.resource_uploader.clear_keys, keys, client=self.client)
+        self._future_keys[future] = keys
+        pending.add(future)
+        while len(pending) >= self.workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            self._handle_results(done)
+        return pending
+
+    def _handle_results(self, futures):
+        for future in futures:
+            keys = self._future_keys.pop(future)
+            try:
+                failures = future.result()
+            except Exception as e:
+                failures = dict((key, e) for key in keys)
+            for key, error in six.iteritems(failures):
+                print("Failed to delete {0}: {1}".format(key, error))
+            self.counts[DELETED] += len(keys) - len(failures)
+            if failures:
+                self.counts[FAILED] += len(failures)
+
+    def _report(self):
+        elapsed = max(time.time() - self.start_time, 0.001)
+        print('Scanned {0} objects ({1} {2}, {3} retained, {4} skipped, {5} failed); '
+              '{6:.1f} objects deleted per second'.format(
+                  sum(self.counts.values()), self.counts[DELETED],
+                  'to delete' if self.dry_run else 'deleted', self.counts[RETAINED],
+                  self.counts[SKIPPED], self.counts[FAILED], self.counts[DELETED] / elapsed))
+
+
+def _get_file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0
+
+
+def _upload_files_to_s3(resource_ids_and_names, resource_ids_and_paths, resource_privacy=None,
+                        workers=DEFAULT_MIGRATION_WORKERS, checkpoint=None, verify_size=False,
+                        bucket_sweep=False):
+    FilestoreMigration(workers=workers, checkpoint=checkpoint, verify_size=verify_size,
+                       bucket_sweep=bucket_sweep).run(
+        resource_ids_and_names, resource_ids_and_paths, resource_privacy)
@@ -2,7 +2,7 @@
 
 import click
 
-from ckanext.s3filestore.cli_commands import S3FilestoreCommands
+from ckanext.s3filestore.cli_commands import S3FilestoreCommands, DEFAULT_MIGRATION_WORKERS
 
 
 @click.group()
@@ -19,16 +19,44 @@ def check_config():
 
 @s3.command()
 @click.argument(u'identifier', default='all')
-def upload(identifier):
+@click.option(u'--workers', type=int, default=DEFAULT_MIGRATION_WORKERS,
+              help=u'Number of files to upload at once')
+@click.option(u'--checkpoint', type=click.Path(dir_okay=False),
+              help=u'Record completed resources in this file and skip those already recorded')
+@click.option(u'--verify-size', is_flag=True,
+              help=u'Upload files again if their size differs from the existing S3 object')
+def upload(identifier, workers, checkpoint, verify_size):
     commands = S3FilestoreCommands()
     if identifier == 'all':
-        commands.upload_all()
+        commands.upload_all(workers=workers, checkpoint=checkpoint, verify_size=verify_size)
     elif identifier == 'pairtree':
-        commands.upload_pairtree()
+        commands.upload_pairtree(workers=workers, checkpoint=checkpoint, verify_size=verify_size)
     else:
-        commands.upload_single(identifier)
+        commands.upload_single(identifier, workers=workers, checkpoint=checkpoint, verify_size=verify_size)
 
 
 @s3.command(short_help=u'Updates the visibility of all existing S3 objects to match current config')
-def update_all_visibility():
-    S3FilestoreCommands().update_all_visibility()
+@click.option(u'--direct', is_flag=True,
+              help=u'Update S3 object ACLs directly, instead of patching each dataset')
+@click.option(u'--dry-run', is_flag=True,
+              help=u'With --direct, report the changes without making them')
+@click.option(u'--checkpoint', type=click.Path(dir_okay=False),
+              help=u'With --direct, record completed datasets in this file and skip those already recorded')
+def update_all_visibility(direct, dry_run, checkpoint):
+    S3FilestoreCommands().update_all_visibility(
+        direct=direct, dry_run=dry_run, checkpoint=checkpoint)
+
+
+@s3.command(short_help=u'Deletes non-current resource uploads across the whole bucket')
+@click.option(u'--days', type=int,
+              help=u'Delete non-current objects at least this many days old '
+                   u'(default: ckanext.s3filestore.delete_non_current_days)')
+@click.option(u'--workers', type=int, default=DEFAULT_MIGRATION_WORKERS,
+              help=u'Number of delete requests to send at once')
+@click.option(u'--dry-run', is_flag=True,
+              help=u'Report how many objects would be deleted without deleting them')
+@click.option(u'--rate-limit', type=float, default=0,
+              help=u'Maximum number of objects to delete per second (default: no limit)')
+def purge_non_current(days, workers, dry_run, rate_limit):
+    S3FilestoreCommands().purge_non_current(
+        days=days, workers=workers, dry_run=dry_run, rate_limit=rate_limit)
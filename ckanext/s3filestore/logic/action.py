@@ -0,0 +1,290 @@
+# encoding: utf-8
+
+import datetime
+import logging
+
+from botocore.exceptions import ClientError
+
+import ckantoolkit as toolkit
+from ckan.lib import munge
+
+from ckanext.s3filestore.multipart import MAX_PARTS, MB
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+log = logging.getLogger(__name__)
+
+UPLOAD_METHODS = ('POST', 'PUT')
+
+
+def _get_max_upload_size():
+    ''' The largest file that may be uploaded straight to S3, in bytes.
+    Defaults to the limit for resource files uploaded through CKAN.
+    '''
+    config = toolkit.config
+    return int(config.get('ckanext.s3filestore.direct_upload_max_size',
+                          config.get('ckan.max_resource_size', 10))) * MB
+
+
+def _get_resource_uploader(context, data_dict):
+    ''' Check access and return the uploader and munged filename
+    for the resource and filename in `data_dict`.
+    '''
+    resource_id, filename = toolkit.get_or_bust(data_dict, ['id', 'filename'])
+    filename = munge.munge_filename(filename)
+    if not filename:
+        raise toolkit.ValidationError({'filename': [toolkit._('Missing value')]})
+    resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
+    return S3ResourceUploader(resource), resource['id'], filename
+
+
+def _get_size(data_dict, max_size, required=False):
+    ''' Validate the optional 'size' in `data_dict` against the limit.
+    '''
+    size = data_dict.get('size')
+    if size is None and not required:
+        return None
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        size = -1
+    if size < 0:
+        raise toolkit.ValidationError({'size': [toolkit._('Must be a whole number of bytes')]})
+    if size > max_size:
+        raise toolkit.ValidationError({'upload': [toolkit._('File upload too large')]})
+    return size
+
+
+def _get_part_numbers(data_dict):
+    ''' Validate the 'part_numbers' in `data_dict`, given as a list
+    or a comma-separated string.
+    '''
+    part_numbers = toolkit.get_or_bust(data_dict, 'part_numbers')
+    try:
+        part_numbers = [int(part_number) for part_number in toolkit.aslist(part_numbers, ',')]
+    except (TypeError, ValueError):
+        part_numbers = []
+    if not part_numbers or not all(1 <= part_number <= MAX_PARTS for part_number in part_numbers):
+        raise toolkit.ValidationError({'part_numbers': [toolkit._(
+            'Must be part numbers from 1 to {0}').format(MAX_PARTS)]})
+    return part_numbers
+
+
+def _call_multipart(function, *args, **kwargs):
+    ''' Call an uploader multipart method, reporting unknown uploads
+    as validation errors.
+    '''
+    try:
+        return function(*args, **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            raise toolkit.ValidationError({'upload_id': [toolkit._('Upload not found')]})
+        raise e
+
+
+def _attach_upload(context, resource_id, filename, metadata):
+    ''' Point the resource at a file that has been uploaded to S3,
+    given its metadata from the uploader, and return the resource.
+    '''
+    resource = toolkit.get_action('resource_patch')(context, {
+        'id': resource_id,
+        'url': filename,
+        'url_type': 'upload',
+        'size': metadata['ContentLength'],
+        'mimetype': metadata['ContentType'],
+        'last_modified': datetime.datetime.utcnow(),
+    })
+
+    # bring the visibility of older uploads into line, as 'upload' does
+    S3ResourceUploader(dict(resource)).update_visibility(resource_id)
+    return resource
+
+
+def s3filestore_presign_upload(context, data_dict):
+    ''' Return a presigned request to upload a resource file straight
+    to S3, without passing it through CKAN. Once the file is uploaded,
+    call ``s3filestore_finalize_upload`` to attach it to the resource.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file to upload
+    :type filename: string
+    :param content_type: the content type of the file
+        (optional, guessed from the filename by default)
+    :type content_type: string
+    :param method: ``POST`` (the default) for a browser form upload,
+        or ``PUT`` to send the file as the request body
+    :type method: string
+    :param size: the size of the file in bytes (required for ``PUT``)
+    :type size: int
+
+    :returns: the ``method`` and ``url`` to use, with the form ``fields``
+        (for ``POST``) or ``headers`` (for ``PUT``) to send unchanged,
+        the S3 ``key`` and how many seconds the request is valid for
+        (``expires_in``)
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_presign_upload', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+
+    method = data_dict.get('method', 'POST').upper()
+    if method not in UPLOAD_METHODS:
+        raise toolkit.ValidationError({'method': [toolkit._('Must be one of: {0}').format(
+            ', '.join(UPLOAD_METHODS))]})
+    max_size = _get_max_upload_size()
+    size = _get_size(data_dict, max_size, required=method == 'PUT')
+
+    log.debug("Presigning %s upload of %s for resource %s", method, filename, resource_id)
+    return upload.presign_upload(
+        resource_id, filename, content_type=data_dict.get('content_type'),
+        max_size=max_size, size=size, method=method)
+
+
+def s3filestore_finalize_upload(context, data_dict):
+    ''' Attach a file uploaded with ``s3filestore_presign_upload``
+    to its resource, once it has been confirmed to be in S3.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file that was uploaded
+    :type filename: string
+
+    :returns: the updated resource
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_finalize_upload', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+
+    metadata = upload.finalize_upload(resource_id, filename, max_size=_get_max_upload_size())
+    return _attach_upload(context, resource_id, filename, metadata)
+
+
+def s3filestore_start_multipart_upload(context, data_dict):
+    ''' Start a multipart upload of a resource file straight to S3,
+    for files too large to send in one request. Upload the parts with
+    ``s3filestore_presign_upload_parts``, then call
+    ``s3filestore_complete_multipart_upload`` to attach the file to the
+    resource, or ``s3filestore_abort_multipart_upload`` to discard it.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file to upload
+    :type filename: string
+    :param content_type: the content type of the file
+        (optional, guessed from the filename by default)
+    :type content_type: string
+    :param size: the size of the file in bytes (optional)
+    :type size: int
+
+    :returns: the ``upload_id``, the S3 ``key``, and the suggested
+        ``part_size`` in bytes; every part but the last must be
+        at least 5 MiB, and there can be at most 10,000 parts
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_start_multipart_upload', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+    size = _get_size(data_dict, _get_max_upload_size())
+    return upload.start_multipart_upload(
+        resource_id, filename, content_type=data_dict.get('content_type'), size=size)
+
+
+def s3filestore_presign_upload_parts(context, data_dict):
+    ''' Return presigned URLs to which the parts of a multipart upload
+    can be sent, each with a ``PUT`` request. Parts may be sent in any
+    order, and in parallel; sending a part again replaces it.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file being uploaded
+    :type filename: string
+    :param upload_id: the id returned by ``s3filestore_start_multipart_upload``
+    :type upload_id: string
+    :param part_numbers: the numbers of the parts, from 1 to 10,000
+    :type part_numbers: list of ints
+
+    :returns: the ``parts``, each with its ``part_number`` and ``url``,
+        and how many seconds the URLs are valid for (``expires_in``)
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_presign_upload_parts', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    urls = upload.presign_upload_parts(resource_id, filename, upload_id, _get_part_numbers(data_dict))
+    return {
+        'parts': [{'part_number': part_number, 'url': url}
+                  for part_number, url in sorted(urls.items())],
+        'expires_in': upload.settings.upload_url_expiry,
+    }
+
+
+def s3filestore_list_upload_parts(context, data_dict):
+    ''' List the parts of a multipart upload that S3 has received,
+    so that an interrupted upload can be resumed.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file being uploaded
+    :type filename: string
+    :param upload_id: the id returned by ``s3filestore_start_multipart_upload``
+    :type upload_id: string
+
+    :returns: the parts received, in order, each with its
+        ``part_number``, ``etag`` and ``size``
+    :rtype: list of dictionaries
+    '''
+    toolkit.check_access('s3filestore_list_upload_parts', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    parts = _call_multipart(upload.list_upload_parts, resource_id, filename, upload_id)
+    return [{'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+            for part in parts]
+
+
+def s3filestore_complete_multipart_upload(context, data_dict):
+    ''' Assemble the parts of a multipart upload that S3 has received
+    into the file, and attach it to its resource.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file being uploaded
+    :type filename: string
+    :param upload_id: the id returned by ``s3filestore_start_multipart_upload``
+    :type upload_id: string
+
+    :returns: the updated resource
+    :rtype: dictionary
+    '''
+    toolkit.check_access('s3filestore_complete_multipart_upload', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    metadata = _call_multipart(
+        upload.complete_multipart_upload, resource_id, filename, upload_id,
+        max_size=_get_max_upload_size())
+    return _attach_upload(context, resource_id, filename, metadata)
+
+
+def s3filestore_abort_multipart_upload(context, data_dict):
+    ''' Abort a multipart upload, discarding any parts received.
+
+    :param id: the id of the resource
+    :type id: string
+    :param filename: the name of the file being uploaded
+    :type filename: string
+    :param upload_id: the id returned by ``s3filestore_start_multipart_upload``
+    :type upload_id: string
+    '''
+    toolkit.check_access('s3filestore_abort_multipart_upload', context, data_dict)
+    upload, resource_id, filename = _get_resource_uploader(context, data_dict)
+    upload_id = toolkit.get_or_bust(data_dict, 'upload_id')
+    _call_multipart(upload.abort_multipart_upload, resource_id, filename, upload_id)
+
+
+def get_actions():
+    return {
+        's3filestore_presign_upload': s3filestore_presign_upload,
+        's3filestore_finalize_upload': s3filestore_finalize_upload,
+        's3filestore_start_multipart_upload': s3filestore_start_multipart_upload,
+        's3filestore_presign_upload_parts': s3filestore_presign_upload_parts,
+        's3filestore_list_upload_parts': s3filestore_list_upload_parts,
+        's3filestore_complete_multipart_upload': s3filestore_complete_multipart_upload,
+        's3filestore_abort_multipart_upload': s3filestore_abort_multipart_upload,
+    }
@@ -0,0 +1,27 @@
+# encoding: utf-8
+
+import ckantoolkit as toolkit
+
+
+def s3filestore_resource_upload(context, data_dict):
+    ''' Only users who may update a resource may upload files for it.
+    '''
+    try:
+        toolkit.check_access('resource_update', context, {'id': data_dict.get('id')})
+    except toolkit.NotAuthorized:
+        return {'success': False,
+                'msg': toolkit._('User {0} not authorized to upload files for resource {1}').format(
+                    context.get('user'), data_dict.get('id'))}
+    return {'success': True}
+
+
+def get_auth_functions():
+    return {
+        's3filestore_presign_upload': s3filestore_resource_upload,
+        's3filestore_finalize_upload': s3filestore_resource_upload,
+        's3filestore_start_multipart_upload': s3filestore_resource_upload,
+        's3filestore_presign_upload_parts': s3filestore_resource_upload,
+        's3filestore_list_upload_parts': s3filestore_resource_upload,
+        's3filestore_complete_multipart_upload': s3filestore_resource_upload,
+        's3filestore_abort_multipart_upload': s3filestore_resource_upload,
+    }
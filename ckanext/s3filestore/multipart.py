@@ -0,0 +1,352 @@
+# encoding: utf-8
+
+import hashlib
+import io
+import logging
+import six
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_PART_SIZE = 8 * MB
+DEFAULT_MULTIPART_CONCURRENCY = 4
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class MultipartWriter(object):
+    ''' A writable sink that streams data to an S3 object.
+
+    Data is buffered until the multipart threshold is reached; objects
+    smaller than that are sent with a single PUT when the writer is
+    closed. Larger objects are sent as a multipart upload, with up to
+    `max_concurrency` parts in flight at once, so memory use is bounded
+    to a few parts regardless of the object size.
+
+    Use as a context manager; if an exception escapes the block,
+    any multipart upload in progress is aborted so that S3 does not
+    retain the orphaned parts.
+
+    `object_args` are passed to both PutObject and CreateMultipartUpload,
+    eg ACL, ContentType, ContentDisposition and Metadata.
+    '''
+
+    def __init__(self, client, bucket_name, key,
+                 threshold=DEFAULT_MULTIPART_THRESHOLD,
+                 part_size=DEFAULT_MULTIPART_PART_SIZE,
+                 max_concurrency=DEFAULT_MULTIPART_CONCURRENCY,
+                 expected_size=None, **object_args):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.object_args = object_args
+        self.threshold = max(threshold, 0)
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        if expected_size:
+            # make sure the whole object fits within the part limit
+            self.part_size = max(self.part_size, -(-expected_size // MAX_PARTS))
+        self.max_concurrency = max(max_concurrency, 1)
+        self.upload_id = None
+        self.bytes_written = 0
+        self.response = None
+        self._buffer = bytearray()
+        self._futures = []
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError("Cannot write to a closed upload")
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        if self.upload_id is None:
+            if len(self._buffer) < max(self.threshold, 1):
+                return
+            self._start()
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+
+    def add_metadata(self, metadata):
+        ''' Add user metadata to the object, if it has not been sent yet.
+        Metadata must be sent when an upload starts, so this is only
+        possible for objects smaller than the multipart threshold.
+
+        Returns True if the metadata will be included.
+        '''
+        if self._closed or self.upload_id is not None:
+            return False
+        self.object_args['Metadata'] = dict(self.object_args.get('Metadata') or {}, **metadata)
+        return True
+
+    def close(self):
+        ''' Send any remaining data and finish the upload.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self.upload_id is None:
+                self.response = self.client.put_object(
+                    Bucket=self.bucket_name, Key=self.key,
+                    Body=bytes(self._buffer), **self.object_args)
+            else:
+                if self._buffer or not self._futures:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self.response = self.client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': parts})
+                log.debug("Completed multipart upload of %s in %s parts",
+                          self.key, len(parts))
+        except Exception:
+            self._closed = False
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._shutdown()
+
+    def abort(self):
+        ''' Discard any buffered data and abort the multipart upload,
+        if one was started.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._buffer = bytearray()
+        for future in self._futures:
+            future.cancel()
+        self._shutdown()
+        if self.upload_id is not None:
+            log.warning("Aborting multipart upload of %s", self.key)
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key,
+                    UploadId=self.upload_id)
+            except Exception as e:
+                log.error("Failed to abort multipart upload %s of %s: %s",
+                          self.upload_id, self.key, e)
+
+    def _start(self):
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, **self.object_args)
+        self.upload_id = response['UploadId']
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        log.debug("Started multipart upload %s of %s", self.upload_id, self.key)
+
+    def _submit_part(self, data):
+        # block until a slot is free, so that at most
+        # 'max_concurrency' parts are held in memory
+        self._slots.acquire()
+        try:
+            self._raise_part_errors()
+            part_number = len(self._futures) + 1
+            future = self._executor.submit(self._upload_part, part_number, data)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _raise_part_errors(self):
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class HashingReader(object):
+    ''' Reads a file once, in chunks, keeping a running MD5 and
+    SHA-256 hash and count of the bytes read.
+
+    Iterate over the reader to get the chunks; once the file is
+    exhausted, `size`, `md5` and `sha256` describe its contents.
+    If `max_size` is set, UploadTooLarge is raised as soon as more
+    than that many bytes have been read.
+    '''
+
+    def __init__(self, source, chunk_size, max_size=None):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+
+    def __iter__(self):
+        while True:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                return
+            chunk = six.ensure_binary(chunk)
+            self.update(chunk)
+            yield chunk
+
+    def update(self, chunk):
+        ''' Hash and count a chunk of data that was read by other means.
+        '''
+        if self.max_size is not None and self.size + len(chunk) > self.max_size:
+            raise UploadTooLarge("Upload exceeds the limit of {} bytes".format(self.max_size))
+        self._md5.update(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+class StagedUpload(io.RawIOBase):
+    ''' A file that streams everything written to it to a staging
+    object in S3, via a MultipartWriter, hashing and counting it on
+    the way. This lets an upload be sent to S3 while it is still being
+    received, without spooling it to disk first.
+
+    Writing is finished by the first seek or read, after which the file
+    reads back from the staging object. Uploaders recognise it, however,
+    and copy the staging object within S3 rather than reading it.
+    Closing the file deletes the staging object, or aborts the upload
+    if it was not finished.
+    '''
+
+    def __init__(self, writer, max_size=None, head_size=2048):
+        super(StagedUpload, self).__init__()
+        self.client = writer.client
+        self.bucket_name = writer.bucket_name
+        self.key = writer.key
+        self.hasher = HashingReader(None, 0, max_size)
+        # the start of the data, to detect its content type
+        self.head = b''
+        self._head_size = head_size
+        self._writer = writer
+        self._staged = False
+        self._position = 0
+        self._body = None
+
+    @property
+    def size(self):
+        return self.hasher.size
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return self._writer is not None
+
+    def seekable(self):
+        return True
+
+    def write(self, data):
+        if self._writer is None:
+            raise ValueError("Cannot write to a finished upload")
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        try:
+            self.hasher.update(data)
+            self._writer.write(data)
+        except Exception:
+            self._abort()
+            raise
+        if len(self.head) < self._head_size:
+            self.head += data[:self._head_size - len(self.head)]
+        self._position += len(data)
+        return len(data)
+
+    def finish(self):
+        ''' Finish sending the data to the staging object.
+        '''
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+            self._staged = True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.finish()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        if offset != self._position:
+            self._close_body()
+            self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        self.finish()
+        if self._position >= self.size or not len(buffer):
+            return 0
+        if self._body is None:
+            self._body = self.client.get_object(
+                Bucket=self.bucket_name, Key=self.key,
+                Range='bytes={}-'.format(self._position))['Body']
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._abort()
+            self._close_body()
+            if self._staged:
+                self._staged = False
+                self.client.delete_object(Bucket=self.bucket_name, Key=self.key)
+                log.debug("Removed staging object %s", self.key)
+        except Exception as e:
+            log.warning("Failed to clean up staging object %s: %s", self.key, e)
+        finally:
+            super(StagedUpload, self).close()
+
+    def _abort(self):
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.abort()
+
+    def _close_body(self):
+        if self._body is not None:
+            body, self._body = self._body, None
+            body.close()
@@ -16,6 +16,17 @@ from ckanext.s3filestore.redis_helper import RedisHelper
 
 LOG = logging.getLogger(__name__)
 
+# where resources being deleted are noted in the action context
+DELETED_RESOURCES_KEY = 's3filestore_deleted_resources'
+
+
+def _clear_download_cache(resource_ids):
+    ''' Discard the cached download details of resources.
+    '''
+    if resource_ids:
+        RedisHelper().delete_many(
+            [resource_id + s3_uploader.DOWNLOAD_CACHE_PATH for resource_id in resource_ids])
+
 
 class S3FileStorePlugin(plugins.SingletonPlugin):
 
@@ -23,6 +34,10 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IUploader)
     plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IResourceController, inherit=True)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     if toolkit.check_ckan_version(min_version='2.9.0'):
         plugins.implements(plugins.IBlueprint)
@@ -79,11 +94,42 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         '''Return an uploader object used to upload general files.'''
         return s3_uploader.S3Uploader(upload_to, old_filename)
 
+    # IActions
+
+    def get_actions(self):
+        from ckanext.s3filestore.logic import action
+        return action.get_actions()
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        from ckanext.s3filestore.logic import auth
+        return auth.get_auth_functions()
+
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        if not toolkit.asbool(config.get('ckanext.s3filestore.stream_uploads', False)):
+            return app
+        # Only Flask apps have a request class that parses uploads
+        if hasattr(app, 'request_class'):
+            from ckanext.s3filestore.streaming import make_streaming_request_class
+            app.request_class = make_streaming_request_class(app.request_class)
+        else:
+            LOG.warning("ckanext.s3filestore.stream_uploads is enabled, but %s has no "
+                        "request class; uploads through it will be spooled to temporary "
+                        "files as usual. Streaming requires CKAN 2.9 or later.",
+                        type(app).__name__)
+        return app
+
     # IPackageController
 
-    # CKAN < 2.10
-    def after_update(self, context, pkg_dict):
-        return self.after_dataset_update(context, pkg_dict)
+    # CKAN < 2.10; called for both packages and resources
+    def after_update(self, context, data):
+        if 'package_id' in data:
+            # a resource; its package update is handled separately
+            return
+        return self.after_dataset_update(context, data)
 
     # CKAN >= 2.10
     def after_dataset_update(self, context, pkg_dict):
@@ -96,8 +142,12 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
         is_private_str = six.text_type(is_private)
 
         redis = RedisHelper()
-        cache_private = redis.get(pkg_id + '/private')
-        redis.put(pkg_id + '/private', is_private_str, expiry=86400)
+        cache_private = redis.get(pkg_id + s3_uploader.PACKAGE_PRIVATE_CACHE_PATH)
+        with redis.batch() as cache:
+            cache.put(pkg_id + s3_uploader.PACKAGE_PRIVATE_CACHE_PATH, is_private_str, expiry=86400)
+            # downloads must be authorised against the updated package
+            cache.delete(*[resource['id'] + s3_uploader.DOWNLOAD_CACHE_PATH
+                           for resource in pkg_dict.get('resources', []) if 'id' in resource])
         # compare current and previous 'private' flags so we know
         # if visibility has changed
         if cache_private is not None and cache_private == is_private_str:
@@ -119,18 +169,59 @@ class S3FileStorePlugin(plugins.SingletonPlugin):
                     context=context, data_dict={'id': pkg_id})
             self.after_update_resource_list_update(visibility_level, pkg_id, pkg_dict)
 
+    # CKAN < 2.10; called for both packages and resources
+    def after_delete(self, context, data):
+        if isinstance(data, dict):
+            return self.after_dataset_delete(context, data)
+        return self.after_resource_delete(context, data)
+
+    # CKAN >= 2.10
+    def after_dataset_delete(self, context, pkg_dict):
+        ''' Stop the resources of a deleted package from being
+        downloaded with cached details.
+        '''
+        from ckan import model
+        resource_ids = [row[0] for row in model.Session.query(model.Resource.id)
+                        .filter(model.Resource.package_id == pkg_dict['id'])]
+        _clear_download_cache(resource_ids)
+
+    # IResourceController
+
+    # CKAN < 2.10
+    def before_delete(self, context, resource, resources):
+        return self.before_resource_delete(context, resource, resources)
+
+    # CKAN >= 2.10
+    def before_resource_delete(self, context, resource, resources):
+        ''' Stop a deleted resource from being downloaded with cached
+        details. The deletion is not committed yet, so the cache is
+        cleared again afterwards, in case a download refilled it.
+        '''
+        _clear_download_cache([resource['id']])
+        context.setdefault(DELETED_RESOURCES_KEY, []).append(resource['id'])
+
+    # CKAN >= 2.10
+    def after_resource_delete(self, context, resources):
+        _clear_download_cache(context.pop(DELETED_RESOURCES_KEY, []))
+
     def after_update_resource_list_update(self, visibility_level, pkg_id, pkg_dict):
 
         LOG.debug("after_update_resource_list_update: Package %s has been updated, notifying resources", pkg_id)
-        for resource in pkg_dict['resources']:
-            if 'id' not in resource:
-                # skip new resources as they would already have correct visibility
-                continue
-            uploader = get_resource_uploader(resource)
-            if hasattr(uploader, 'update_visibility'):
-                uploader.update_visibility(
-                    resource['id'],
-                    target_acl=visibility_level)
+        # skip new resources as they would already have correct visibility
+        resources = [resource for resource in pkg_dict['resources'] if 'id' in resource]
+        if not resources:
+            return
+        uploader = get_resource_uploader(resources[0])
+        if hasattr(uploader, 'update_package_visibility'):
+            # update every resource in one batch
+            uploader.update_package_visibility(resources, target_acl=visibility_level)
+        else:
+            for resource in resources:
+                uploader = get_resource_uploader(resource)
+                if hasattr(uploader, 'update_visibility'):
+                    uploader.update_visibility(
+                        resource['id'],
+                        target_acl=visibility_level)
         LOG.debug("after_update_resource_list_update: Package %s has been updated, notifying resources finished", pkg_id)
 
     def enqueue_resource_visibility_update_job(self, visibility_level, pkg_id):
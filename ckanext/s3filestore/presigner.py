@@ -0,0 +1,189 @@
+# encoding: utf-8
+
+import datetime
+import hashlib
+import hmac
+import logging
+import threading
+import weakref
+
+import pytz
+import six
+from six.moves.urllib.parse import parse_qsl, quote, urlsplit
+
+log = logging.getLogger(__name__)
+
+ALGORITHM = 'AWS4-HMAC-SHA256'
+SIGV4_TIMESTAMP = '%Y%m%dT%H%M%SZ'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+# characters that botocore leaves unencoded in query strings and keys
+SAFE_CHARS = '-_.~'
+# GetObject parameters that can be signed, and their query string names
+QUERY_PARAMETERS = {
+    'ResponseCacheControl': 'response-cache-control',
+    'ResponseContentDisposition': 'response-content-disposition',
+    'ResponseContentEncoding': 'response-content-encoding',
+    'ResponseContentLanguage': 'response-content-language',
+    'ResponseContentType': 'response-content-type',
+    'VersionId': 'versionId',
+}
+AUTH_PARAMETERS = ('X-Amz-Algorithm', 'X-Amz-Credential', 'X-Amz-Date',
+                   'X-Amz-Expires', 'X-Amz-SignedHeaders', 'X-Amz-Signature')
+# how many signing keys to hold; there is normally one per day
+MAX_SIGNING_KEYS = 16
+
+
+def _percent_encode(value, safe=SAFE_CHARS):
+    if not isinstance(value, (six.binary_type, six.text_type)):
+        value = six.text_type(value)
+    if not isinstance(value, six.binary_type):
+        value = value.encode('utf-8')
+    return quote(value, safe=safe)
+
+
+def _sign(key, message):
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256)
+
+
+def _get_current_datetime():
+    return datetime.datetime.now(pytz.utc)
+
+
+class _UrlTemplate(object):
+    ''' The parts of a presigned GetObject URL that depend only
+    on the client and bucket, as worked out by botocore.
+    '''
+
+    def __init__(self, client, bucket_name):
+        url = client.generate_presigned_url(
+            ClientMethod='get_object', Params={'Bucket': bucket_name, 'Key': 'x'})
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        credential = query.get('X-Amz-Credential', '').split('/')
+        self.supported = (
+            query.get('X-Amz-Algorithm') == ALGORITHM
+            and query.get('X-Amz-SignedHeaders') == 'host'
+            and set(query) - {'X-Amz-Security-Token'} == set(AUTH_PARAMETERS)
+            and len(credential) == 5
+            and parts.path.endswith('/x'))
+        if not self.supported:
+            log.debug("Presigned URLs for %s are not SigV4 URLs that can be "
+                      "generated locally; using botocore instead", bucket_name)
+            return
+        self.base_url = parts.scheme + '://' + parts.netloc
+        self.path_prefix = parts.path[:-1]
+        self.host = parts.hostname
+        if ':' in self.host:
+            # IPv6 address
+            self.host = '[' + self.host + ']'
+        if parts.port is not None and parts.port != {'http': 80, 'https': 443}.get(parts.scheme):
+            self.host = '{0}:{1}'.format(self.host, parts.port)
+        self.region_name = credential[2]
+        self.service_name = credential[3]
+
+
+class S3Presigner(object):
+    ''' Generates presigned GetObject URLs that are identical to those
+    from botocore's 'generate_presigned_url', without going through
+    its request-building and event machinery.
+
+    The endpoint and signing scope are worked out by botocore once per
+    client and bucket. SigV4 signing keys are derived once per day,
+    so each URL only needs the final HMAC. If a URL cannot be
+    generated locally, eg for older signature versions or unknown
+    parameters, botocore is used instead.
+    '''
+
+    def __init__(self):
+        self._templates = weakref.WeakKeyDictionary()
+        self._signing_keys = {}
+        self._lock = threading.Lock()
+
+    def generate_presigned_url(self, client, bucket_name, key, expires_in, params=None):
+        ''' Return a presigned URL for getting an object,
+        equivalent to calling `client.generate_presigned_url`.
+        '''
+        params = params or {}
+        template = self._get_template(client, bucket_name)
+        credentials = self._get_credentials(client)
+        if template.supported and credentials is not None \
+                and all(name in QUERY_PARAMETERS for name in params):
+            return self._sign_url(template, credentials, key, expires_in, params)
+
+        url_params = {'Bucket': bucket_name, 'Key': key}
+        url_params.update(params)
+        return client.generate_presigned_url(
+            ClientMethod='get_object', Params=url_params, ExpiresIn=expires_in)
+
+    def _get_template(self, client, bucket_name):
+        templates = self._templates.get(client)
+        if templates is None:
+            with self._lock:
+                templates = self._templates.setdefault(client, {})
+        template = templates.get(bucket_name)
+        if template is None:
+            template = templates[bucket_name] = _UrlTemplate(client, bucket_name)
+        return template
+
+    def _get_credentials(self, client):
+        credentials = getattr(getattr(client, '_request_signer', None), '_credentials', None)
+        if credentials is None:
+            return None
+        # refreshes temporary credentials if necessary
+        return credentials.get_frozen_credentials()
+
+    def _get_signing_key(self, secret_key, date_stamp, region_name, service_name):
+        cache_key = (secret_key, date_stamp, region_name, service_name)
+        signing_key = self._signing_keys.get(cache_key)
+        if signing_key is None:
+            signing_key = ('AWS4' + secret_key).encode('utf-8')
+            for part in (date_stamp, region_name, service_name, 'aws4_request'):
+                signing_key = _sign(signing_key, part).digest()
+            with self._lock:
+                if len(self._signing_keys) >= MAX_SIGNING_KEYS:
+                    self._signing_keys.clear()
+                self._signing_keys[cache_key] = signing_key
+        return signing_key
+
+    def _sign_url(self, template, credentials, key, expires_in, params):
+        timestamp = _get_current_datetime().strftime(SIGV4_TIMESTAMP)
+        date_stamp = timestamp[0:8]
+        credential_scope = '/'.join(
+            (date_stamp, template.region_name, template.service_name, 'aws4_request'))
+        path = template.path_prefix + _percent_encode(key, safe='/~')
+
+        query = [(QUERY_PARAMETERS[name], value) for name, value in six.iteritems(params)]
+        query.extend([
+            ('X-Amz-Algorithm', ALGORITHM),
+            ('X-Amz-Credential', credentials.access_key + '/' + credential_scope),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', expires_in),
+            ('X-Amz-SignedHeaders', 'host'),
+        ])
+        if credentials.token is not None:
+            query.append(('X-Amz-Security-Token', credentials.token))
+        query = [(_percent_encode(name), _percent_encode(value)) for name, value in query]
+        query_string = '&'.join(name + '=' + value for name, value in query)
+
+        canonical_request = '\n'.join((
+            'GET',
+            path,
+            '&'.join(name + '=' + value for name, value in sorted(query)),
+            'host:' + template.host + '\n',
+            'host',
+            UNSIGNED_PAYLOAD,
+        ))
+        string_to_sign = '\n'.join((
+            ALGORITHM,
+            timestamp,
+            credential_scope,
+            hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+        ))
+        signing_key = self._get_signing_key(
+            credentials.secret_key, date_stamp, template.region_name, template.service_name)
+        signature = _sign(signing_key, string_to_sign).hexdigest()
+        return '{0}{1}?{2}&X-Amz-Signature={3}'.format(
+            template.base_url, path, query_string, signature)
+
+
+presigner = S3Presigner()
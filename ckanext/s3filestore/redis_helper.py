@@ -1,53 +1,416 @@
 # encoding: utf-8
 
+from collections import OrderedDict
+import json
 import logging
+import os
 import six
+import threading
+import time
+import uuid
 
+import ckantoolkit as toolkit
 from ckan.lib.redis import connect_to_redis
 
+config = toolkit.config
 log = logging.getLogger(__name__)
 
 REDIS_PREFIX = 'ckanext-s3filestore:'
+INVALIDATION_CHANNEL = REDIS_PREFIX + 'invalidate'
+DEFAULT_LOCAL_CACHE_SIZE = 1000
+DEFAULT_LOCAL_CACHE_MAX_AGE = 300
+# seconds to wait before resubscribing to invalidation messages
+RESUBSCRIBE_DELAY = 5
+
+
+def _to_text(cache_value):
+    if cache_value is not None and hasattr(six, 'ensure_text'):
+        cache_value = six.ensure_text(cache_value)
+    return cache_value
+
+
+class LocalCache(object):
+    ''' A bounded, thread-safe, in-process LRU cache in front of Redis.
+
+    Entries expire no later than their Redis counterparts, and after
+    at most `max_age` seconds. Once `max_size` entries are held, the
+    least recently used entry is evicted to make room for a new one.
+
+    Every invalidation increments `generation`, so that a value read
+    from Redis before an invalidation cannot be stored afterward.
+    '''
+
+    def __init__(self, max_size=DEFAULT_LOCAL_CACHE_SIZE,
+                 max_age=DEFAULT_LOCAL_CACHE_MAX_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Get an unexpired value, or None if there is none.
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > time.time():
+                # re-insert to mark the entry as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, expiry, generation=None):
+        ''' Store a value for up to `expiry` seconds. If `generation`
+        is specified and does not match the current generation, the
+        value may be outdated, so it is not stored.
+        '''
+        if value is None or not expiry or expiry <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + min(expiry, self.max_age))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        ''' Discard the values of the specified keys, if held.
+        '''
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        ''' Discard all values.
+        '''
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def get_stats(self):
+        ''' Return a dict of the hit, miss and eviction counts,
+        and the number of entries currently held.
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._entries)}
+
+
+class _InvalidationListener(object):
+    ''' Applies invalidations published by other processes to a
+    LocalCache, on a daemon thread.
+
+    The cache should only be used while `listening` is True;
+    if the subscription is lost, the cache is cleared, since
+    invalidations may have been missed.
+    '''
+
+    def __init__(self, local_cache, origin):
+        self.local_cache = local_cache
+        self.origin = origin
+        self.listening = False
+        thread = threading.Thread(target=self._run, name='s3filestore-cache-invalidation')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = connect_to_redis().pubsub()
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        self.local_cache.clear()
+                        self.listening = True
+                    elif message['type'] == 'message':
+                        self._handle(message['data'])
+            except Exception as e:
+                log.warning("Lost subscription to Redis cache invalidations: %s", e)
+            self.listening = False
+            self.local_cache.clear()
+            time.sleep(RESUBSCRIBE_DELAY)
+
+    def _handle(self, data):
+        try:
+            message = json.loads(_to_text(data))
+        except ValueError:
+            log.warning("Ignoring invalid cache invalidation message: %s", data)
+            return
+        if message.get('origin') != self.origin:
+            self.local_cache.invalidate(message.get('keys', []))
+
+
+class RedisBatch(object):
+    ''' Collects cache updates so they can be sent to Redis
+    in a single pipelined round trip.
+
+    Operations are applied in the order they were added. When used
+    as a context manager, they are sent even if the block raises an
+    exception, so that invalidations for changes already made to S3
+    are not lost. Operations may be added from multiple threads.
+    '''
+
+    def __init__(self, helper):
+        self.helper = helper
+        self._operations = []
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.execute()
+
+    def put(self, key, value, expiry=None):
+        ''' Queue a value to be set, with the specified expiry.
+        If expiry is None, no action is taken.
+        '''
+        if expiry:
+            with self._lock:
+                self._operations.append(('set', self.helper._get_cache_key(key), value, expiry))
+                self._keys.append(key)
+
+    def delete(self, *keys):
+        ''' Queue one or more keys to be deleted.
+        '''
+        if keys:
+            with self._lock:
+                self._operations.append(
+                    ('delete', [self.helper._get_cache_key(key) for key in keys]))
+                self._keys.extend(keys)
+
+    def execute(self):
+        ''' Send all queued operations to Redis, with a single
+        invalidation message for all of the keys they change.
+        The batch may be reused afterward.
+        '''
+        with self._lock:
+            operations, self._operations = self._operations, []
+            keys, self._keys = self._keys, []
+        if not operations:
+            return
+        keys = list(OrderedDict.fromkeys(keys))
+        try:
+            pipeline = self.helper._get_connection().pipeline(transaction=False)
+            for operation in operations:
+                if operation[0] == 'set':
+                    pipeline.set(operation[1], operation[2], ex=operation[3])
+                else:
+                    pipeline.delete(*operation[1])
+            self.helper._execute(pipeline, keys)
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
 
 
 class RedisHelper:
 
+    # Redis clients are thread-safe and manage their own connection pool,
+    # so one is shared by every helper in the process.
+    _connection = None
+
+    # Frequently read values are also held in process memory.
+    # Every change made through a helper is published to the other
+    # processes, so that they can discard their copies.
+    _local_cache = None
+    _listener = None
+    _origin = None
+    _pid = None
+    _local_cache_lock = threading.Lock()
+
+    def _get_connection(self):
+        if RedisHelper._connection is None:
+            RedisHelper._connection = connect_to_redis()
+        return RedisHelper._connection
+
     def _get_cache_key(self, path):
         return REDIS_PREFIX + path
 
+    def _get_local_cache(self):
+        ''' Return the in-process cache, or None if it is disabled
+        or is not currently receiving invalidations.
+        '''
+        if RedisHelper._pid != os.getpid():
+            with RedisHelper._local_cache_lock:
+                # the listener thread does not survive a fork, so
+                # each process needs its own cache and listener
+                if RedisHelper._pid != os.getpid():
+                    RedisHelper._origin = uuid.uuid4().hex
+                    RedisHelper._local_cache = None
+                    RedisHelper._listener = None
+                    max_size = int(config.get(
+                        'ckanext.s3filestore.local_cache_size', DEFAULT_LOCAL_CACHE_SIZE))
+                    if max_size > 0:
+                        RedisHelper._local_cache = LocalCache(max_size, int(config.get(
+                            'ckanext.s3filestore.local_cache_max_age', DEFAULT_LOCAL_CACHE_MAX_AGE)))
+                        RedisHelper._listener = _InvalidationListener(
+                            RedisHelper._local_cache, RedisHelper._origin)
+                    RedisHelper._pid = os.getpid()
+        if RedisHelper._listener is not None and RedisHelper._listener.listening:
+            return RedisHelper._local_cache
+        return None
+
+    def _execute(self, pipeline, keys):
+        ''' Execute a pipeline that changes the specified keys,
+        telling other processes to discard their copies of them,
+        and then discard local copies.
+        '''
+        self._get_local_cache()
+        try:
+            pipeline.publish(INVALIDATION_CHANNEL, json.dumps(
+                {'origin': RedisHelper._origin, 'keys': list(keys)}))
+            pipeline.execute()
+        finally:
+            # only now can a concurrent read no longer see the old values
+            if RedisHelper._local_cache is not None:
+                RedisHelper._local_cache.invalidate(keys)
+
+    def get_local_cache_stats(self):
+        ''' Return a dict of the in-process cache hit, miss and eviction
+        counts, and its current size, or None if it is disabled.
+        '''
+        self._get_local_cache()
+        if RedisHelper._local_cache is None:
+            return None
+        return RedisHelper._local_cache.get_stats()
+
     def get(self, key):
         ''' Get a value from the cache, if available.
         Returned values will be converted to text type instead of bytes.
         '''
+        local_cache = self._get_local_cache()
+        if local_cache is not None:
+            cache_value = local_cache.get(key)
+            if cache_value is not None:
+                return cache_value
+            generation = local_cache.generation
+
         cache_key = self._get_cache_key(key)
         try:
-            redis_conn = connect_to_redis()
-            cache_value = redis_conn.get(cache_key)
+            if local_cache is not None:
+                # find out how long the value can be held locally
+                pipeline = self._get_connection().pipeline(transaction=False)
+                pipeline.get(cache_key)
+                pipeline.ttl(cache_key)
+                cache_value, ttl = pipeline.execute()
+                local_cache.put(key, _to_text(cache_value), ttl, generation)
+            else:
+                cache_value = self._get_connection().get(cache_key)
         except Exception as e:
             log.error("Failed to connect to Redis cache: %s", e)
             cache_value = None
-        if cache_value is not None and hasattr(six, 'ensure_text'):
-            cache_value = six.ensure_text(cache_value)
-        return cache_value
+        return _to_text(cache_value)
 
     def put(self, key, value, expiry=None):
         ''' Set a URL value in the cache, if available, with the
         specified expiry. If expiry is None, no action is taken.
+
+        Each call publishes an invalidation message to every process;
+        use 'batch' or 'put_many' for bulk changes.
         '''
         if expiry:
             cache_key = self._get_cache_key(key)
             try:
-                redis_conn = connect_to_redis()
-                redis_conn.set(cache_key, value, ex=expiry)
+                pipeline = self._get_connection().pipeline(transaction=False)
+                pipeline.set(cache_key, value, ex=expiry)
+                self._execute(pipeline, [key])
             except Exception as e:
                 log.error("Failed to connect to Redis cache: %s", e)
 
     def delete(self, key):
         ''' Delete a value from the cache, if available.
+
+        Each call publishes an invalidation message to every process;
+        use 'batch' or 'delete_many' for bulk changes.
+        '''
+        cache_key = self._get_cache_key(key)
+        try:
+            pipeline = self._get_connection().pipeline(transaction=False)
+            pipeline.delete(cache_key)
+            self._execute(pipeline, [key])
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+
+    def acquire_lock(self, key, expiry):
+        ''' Try to take a lock shared by all processes, which is
+        released automatically after `expiry` seconds.
+
+        Returns a token with which to release the lock, or None if
+        it is already held. If Redis is unavailable, every caller
+        is given the lock, so that work is not blocked.
+        '''
+        token = uuid.uuid4().hex
+        try:
+            if self._get_connection().set(self._get_cache_key(key), token, nx=True, ex=expiry):
+                return token
+            return None
+        except Exception as e:
+            log.error("Failed to connect to Redis cache: %s", e)
+            return token
+
+    def release_lock(self, key, token):
+        ''' Release a lock taken with 'acquire_lock',
+        unless it has already expired and been taken by another caller.
         '''
         cache_key = self._get_cache_key(key)
         try:
-            redis_conn = connect_to_redis()
-            redis_conn.delete(cache_key)
+            with self._get_connection().pipeline() as pipeline:
+                pipeline.watch(cache_key)
+                if _to_text(pipeline.get(cache_key)) == token:
+                    pipeline.multi()
+                    pipeline.delete(cache_key)
+                    pipeline.execute()
+                else:
+                    pipeline.unwatch()
+        except Exception as e:
+            # most likely the lock changed hands while we were releasing it
+            log.warning("Failed to release lock %s: %s", key, e)
+
+    def batch(self):
+        ''' Start a batch of cache updates, to be sent in one round trip.
+        Use as a context manager, or call 'execute' when done.
+        '''
+        return RedisBatch(self)
+
+    def get_many(self, keys):
+        ''' Get multiple values from the cache in one round trip.
+        Returns a list in the same order as 'keys', with None
+        for any value that is not available.
+
+        Values are always read from Redis, not the in-process cache.
+        '''
+        keys = list(keys)
+        if not keys:
+            return []
+        try:
+            cache_values = self._get_connection().mget(
+                [self._get_cache_key(key) for key in keys])
         except Exception as e:
             log.error("Failed to connect to Redis cache: %s", e)
+            cache_values = [None] * len(keys)
+        return [_to_text(cache_value) for cache_value in cache_values]
+
+    def put_many(self, values, expiry=None):
+        ''' Set multiple values in the cache in one round trip,
+        with the specified expiry, publishing one invalidation message.
+        'values' is a dict of keys to values.
+        If expiry is None, no action is taken.
+        '''
+        with self.batch() as batch:
+            for key, value in six.iteritems(values):
+                batch.put(key, value, expiry=expiry)
+
+    def delete_many(self, keys):
+        ''' Delete multiple values from the cache in one round trip,
+        publishing one invalidation message.
+        '''
+        with self.batch() as batch:
+            batch.delete(*keys)
@@ -0,0 +1,65 @@
+# encoding: utf-8
+
+import logging
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import ckantoolkit as toolkit
+
+from ckanext.s3filestore.multipart import MB, UploadTooLarge
+from ckanext.s3filestore.uploader import BaseS3Uploader, get_settings
+
+log = logging.getLogger(__name__)
+
+
+def _get_max_upload_size():
+    ''' The largest file CKAN accepts for any upload, in bytes.
+    Uploaders apply their own limits when the file is copied into place.
+    '''
+    config = toolkit.config
+    return max(int(config.get('ckan.max_resource_size', 10)),
+               int(config.get('ckan.max_image_size', 2))) * MB
+
+
+def make_streaming_request_class(base_class):
+    ''' Return a subclass of the Flask request class `base_class`
+    that streams uploaded files to S3 as the request body is parsed,
+    instead of spooling them to temporary files.
+
+    Only requests larger than the multipart threshold are streamed;
+    smaller files are held in memory as usual.
+    '''
+
+    class S3StreamingRequest(base_class):
+
+        def _get_file_stream(self, total_content_length, content_type,
+                             filename=None, content_length=None):
+            if total_content_length is not None \
+                    and total_content_length < get_settings().multipart_threshold:
+                return super(S3StreamingRequest, self)._get_file_stream(
+                    total_content_length, content_type,
+                    filename=filename, content_length=content_length)
+
+            stream = BaseS3Uploader().open_staged_upload(max_size=_get_max_upload_size())
+            log.debug("Streaming upload of %s to %s", filename, stream.key)
+            if not hasattr(self, '_staged_uploads'):
+                self._staged_uploads = []
+            self._staged_uploads.append(stream)
+            return stream
+
+        def _load_form_data(self):
+            try:
+                super(S3StreamingRequest, self)._load_form_data()
+            except UploadTooLarge as e:
+                log.info("Rejected streamed upload: %s", e)
+                raise RequestEntityTooLarge()
+
+        def close(self):
+            try:
+                super(S3StreamingRequest, self).close()
+            finally:
+                # files that were not fully parsed are not closed by werkzeug
+                for stream in getattr(self, '_staged_uploads', []):
+                    stream.close()
+
+    return S3StreamingRequest
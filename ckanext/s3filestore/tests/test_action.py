@@ -0,0 +1,127 @@
+# encoding: utf-8
+
+import requests
+
+import pytest
+
+from ckan.plugins import toolkit
+from ckan.plugins.toolkit import config
+from ckan.tests import helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore.uploader import BaseS3Uploader
+
+
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+class TestDirectUpload(object):
+
+    def setup_method(self, test_method):
+        self.sysadmin = factories.Sysadmin()
+        uploader = BaseS3Uploader()
+        self.s3 = uploader.get_s3_client()
+        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
+        uploader.get_s3_bucket(self.bucket_name)
+        dataset = factories.Dataset()
+        self.resource = helpers.call_action(
+            'resource_create', package_id=dataset['id'], url='http://example')
+
+    def _call_action(self, action, **kwargs):
+        context = {'user': self.sysadmin['name'], 'ignore_auth': False}
+        return helpers.call_action(action, context=context, **kwargs)
+
+    def test_presigned_post_and_finalize(self):
+        '''A file posted straight to S3 is attached to the resource
+        when the upload is finalized.'''
+        form = self._call_action(
+            's3filestore_presign_upload', id=self.resource['id'], filename='data.csv')
+        assert form['method'] == 'POST'
+        assert form['key'] == '{0}/resources/{1}/data.csv'.format(
+            config.get('ckanext.s3filestore.aws_storage_path'), self.resource['id'])
+
+        response = requests.post(form['url'], data=form['fields'],
+                                 files={'file': ('data.csv', b'date,price\n2021-01-01,1\n')})
+        assert response.status_code in [200, 201, 204]
+        metadata = self.s3.head_object(Bucket=self.bucket_name, Key=form['key'])
+        assert metadata['ContentType'] == 'text/csv'
+        assert metadata['Metadata']['package_id'] == self.resource['package_id']
+
+        resource = self._call_action(
+            's3filestore_finalize_upload', id=self.resource['id'], filename='data.csv')
+        assert resource['url_type'] == 'upload'
+        assert resource['url'].endswith('/download/data.csv')
+        assert int(resource['size']) == 24
+
+    def test_presigned_put(self):
+        '''A file can be sent to S3 with a presigned PUT,
+        using the headers provided.'''
+        request = self._call_action(
+            's3filestore_presign_upload', id=self.resource['id'], filename='data.txt',
+            method='PUT', size=5)
+        response = requests.put(request['url'], data=b'hello', headers=request['headers'])
+        assert response.status_code == 200
+        metadata = self.s3.head_object(Bucket=self.bucket_name, Key=request['key'])
+        assert metadata['ContentType'] == 'text/plain'
+
+    def test_multipart_upload(self):
+        '''A file can be uploaded to S3 in parts, listing the parts
+        received so far, and attached to the resource on completion.'''
+        start = self._call_action(
+            's3filestore_start_multipart_upload', id=self.resource['id'], filename='data.csv')
+        upload_args = {'id': self.resource['id'], 'filename': 'data.csv', 'upload_id': start['upload_id']}
+        urls = self._call_action('s3filestore_presign_upload_parts', part_numbers=[1, 2], **upload_args)
+        assert [part['part_number'] for part in urls['parts']] == [1, 2]
+
+        first_part = b'date,price\n' + b'x' * (5 * 1024 * 1024)
+        assert requests.put(urls['parts'][0]['url'], data=first_part).status_code == 200
+        parts = self._call_action('s3filestore_list_upload_parts', **upload_args)
+        assert [part['part_number'] for part in parts] == [1]
+        assert requests.put(urls['parts'][1]['url'], data=b'\n').status_code == 200
+
+        resource = self._call_action('s3filestore_complete_multipart_upload', **upload_args)
+        assert resource['url'].endswith('/download/data.csv')
+        assert int(resource['size']) == len(first_part) + 1
+        metadata = self.s3.head_object(Bucket=self.bucket_name, Key=start['key'])
+        assert metadata['ContentType'] == 'text/csv'
+        assert metadata['ContentDisposition'] == 'attachment; filename=data.csv'
+
+    def test_multipart_upload_abort(self):
+        '''An aborted multipart upload cannot be resumed.'''
+        start = self._call_action(
+            's3filestore_start_multipart_upload', id=self.resource['id'], filename='data.csv')
+        upload_args = {'id': self.resource['id'], 'filename': 'data.csv', 'upload_id': start['upload_id']}
+        self._call_action('s3filestore_abort_multipart_upload', **upload_args)
+        with pytest.raises(toolkit.ValidationError):
+            self._call_action('s3filestore_list_upload_parts', **upload_args)
+
+    def test_finalize_without_upload(self):
+        '''A file that has not been uploaded cannot be finalized.'''
+        with pytest.raises(toolkit.ValidationError):
+            self._call_action(
+                's3filestore_finalize_upload', id=self.resource['id'], filename='missing.csv')
+
+    def test_presign_too_large(self):
+        '''Files larger than the CKAN upload limit are refused.'''
+        with pytest.raises(toolkit.ValidationError):
+            self._call_action(
+                's3filestore_presign_upload', id=self.resource['id'], filename='data.csv',
+                method='PUT', size=1024 * 1024 * 1024)
+
+    @helpers.change_config('ckanext.s3filestore.direct_upload_max_size', '2048')
+    def test_presign_direct_upload_limit(self):
+        '''Direct uploads can have their own, larger, size limit.'''
+        request = self._call_action(
+            's3filestore_presign_upload', id=self.resource['id'], filename='data.csv',
+            method='PUT', size=1024 * 1024 * 1024)
+        assert request['method'] == 'PUT'
+        with pytest.raises(toolkit.ValidationError):
+            self._call_action(
+                's3filestore_presign_upload', id=self.resource['id'], filename='data.csv',
+                method='PUT', size=4 * 1024 * 1024 * 1024)
+
+    def test_presign_not_authorized(self):
+        '''Users who cannot update the resource cannot upload to it.'''
+        user = factories.User()
+        context = {'user': user['name'], 'ignore_auth': False}
+        with pytest.raises(toolkit.NotAuthorized):
+            helpers.call_action('s3filestore_presign_upload', context=context,
+                                id=self.resource['id'], filename='data.csv')
@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+import io
+import os
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import pytest
+
+from botocore.exceptions import ClientError
+from botocore.paginate import Paginator
+
+from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from ckan.tests import helpers
+import ckan.tests.factories as factories
+
+from ckanext.s3filestore.cli_commands import FilestoreMigration, S3FilestoreCommands, \
+    _upload_files_to_s3
+from ckanext.s3filestore.uploader import S3ResourceUploader
+
+from .test_uploader import _setup_function, _get_object_key
+
+
+def _transferred_ids(transfer):
+    return sorted(call[0][1] for call in transfer.call_args_list)
+
+
+class TestFilestoreMigration():
+
+    @pytest.fixture(autouse=True)
+    def _setup_filestore(self, tmpdir):
+        _setup_function(self)
+        self.uploader = S3ResourceUploader({'url': ''})
+        self.checkpoint = str(tmpdir.join('checkpoint'))
+        self.resource_ids = [factories.Resource(url='http://example.com/data.csv')['id']
+                             for _ in range(3)]
+        self.names = dict((resource_id, 'data.csv') for resource_id in self.resource_ids)
+        self.paths = {}
+        for resource_id in self.resource_ids:
+            self.paths[resource_id] = str(tmpdir.join(resource_id))
+            with io.open(self.paths[resource_id], 'wb') as local_file:
+                local_file.write(b'date,price\n2021-01-01,1\n')
+
+    def _get_key(self, resource_id):
+        return self.uploader.get_path(resource_id, 'data.csv')
+
+    def _migrate(self, **kwargs):
+        with mock.patch.object(FilestoreMigration, '_transfer', autospec=True,
+                               side_effect=FilestoreMigration._transfer) as transfer:
+            _upload_files_to_s3(self.names, self.paths, workers=2, **kwargs)
+        return _transferred_ids(transfer)
+
+    def _read_checkpoint(self):
+        with io.open(self.checkpoint) as checkpoint_file:
+            return sorted(line.strip() for line in checkpoint_file)
+
+    def test_resume_from_checkpoint(self):
+        ''' Resources recorded in the checkpoint are not uploaded again,
+        and those that fail are not recorded.
+        '''
+        done, pending, missing = self.resource_ids
+        with io.open(self.checkpoint, 'w') as checkpoint_file:
+            checkpoint_file.write(done + '\n')
+        os.remove(self.paths[missing])
+        self.paths[missing] += '.missing'
+
+        assert self._migrate(checkpoint=self.checkpoint) == sorted([pending, missing])
+        assert self._read_checkpoint() == sorted([done, pending])
+        self.s3.head_object(Bucket=self.bucket_name, Key=self._get_key(pending))
+        with pytest.raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=self._get_key(done))
+        assert helpers.call_action('resource_show', id=pending)['url'] == 'data.csv'
+
+        # only the failed resource is attempted again
+        assert self._migrate(checkpoint=self.checkpoint) == [missing]
+        assert self._read_checkpoint() == sorted([done, pending])
+
+    def test_verify_size(self):
+        ''' Files already in S3 are skipped, unless their size is
+        checked and differs from the local file.
+        '''
+        assert self._migrate() == sorted(self.resource_ids)
+        changed = self.resource_ids[1]
+        with io.open(self.paths[changed], 'wb') as local_file:
+            local_file.write(b'changed')
+
+        assert self._migrate() == []
+        assert self._migrate(verify_size=True) == [changed]
+        s3_object = self.s3.get_object(Bucket=self.bucket_name, Key=self._get_key(changed))
+        assert s3_object['Body'].read() == b'changed'
+
+
+class TestNonCurrentPurge():
+
+    def setup_method(self, test_method):
+        _setup_function(self)
+        self.uploader = S3ResourceUploader({'url': ''})
+        dataset = factories.Dataset()
+        resource = self._upload_resource(dataset)
+        deleted_resource = self._upload_resource(dataset)
+        helpers.call_action('resource_delete', id=deleted_resource['id'])
+        link_resource = factories.Resource(package_id=dataset['id'], url='http://example.com/data.csv')
+
+        self.current_key = _get_object_key(resource)
+        self.old_key = self._put_object(resource, 'old.csv')
+        self.recent_key = self._put_object(resource, 'recent.csv')
+        # objects of resources that are not active uploads
+        self.other_keys = [self._put_object(deleted_resource, 'old.csv'),
+                           self._put_object(link_resource, 'old.csv')]
+
+    def _upload_resource(self, dataset):
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        return helpers.call_action(
+            'resource_create', package_id=dataset['id'],
+            upload=FlaskFileStorage(io.open(file_path, 'rb')), url='data.csv')
+
+    def _put_object(self, resource, filename):
+        key = self.uploader.get_path(resource['id'], filename)
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'old')
+        return key
+
+    def _list_keys(self):
+        return set(s3_object['Key'] for page in self.uploader.iter_object_pages(
+            self.uploader.storage_path + '/') for s3_object in page)
+
+    def _purge(self, **kwargs):
+        # everything but the 'recent' objects is older than the limit
+        with mock.patch('ckanext.s3filestore.cli_commands._get_object_age_days',
+                        side_effect=lambda s3_object: 0 if 'recent' in s3_object['Key'] else 100):
+            S3FilestoreCommands().purge_non_current(days=30, **kwargs)
+
+    def _assert_only_old_key_deleted(self, keys_before):
+        keys_after = self._list_keys()
+        assert self.old_key in keys_before
+        assert keys_after == keys_before - set([self.old_key])
+        assert set([self.current_key, self.recent_key] + self.other_keys) <= keys_after
+
+    def test_purge_non_current(self):
+        ''' Old objects that are not the current upload of an active
+        resource are deleted; everything else is kept.
+        '''
+        keys_before = self._list_keys()
+        self._purge(workers=2)
+        self._assert_only_old_key_deleted(keys_before)
+
+    def test_purge_across_pages(self):
+        ''' Resources whose objects span several pages of listings
+        are handled the same way.
+        '''
+        keys_before = self._list_keys()
+        # force one object per page
+        paginate = Paginator.paginate
+        with mock.patch.object(Paginator, 'paginate', side_effect=lambda self, **kwargs: paginate(
+                self, PaginationConfig={'PageSize': 1}, **kwargs)):
+            self._purge(workers=2)
+        self._assert_only_old_key_deleted(keys_before)
+
+    def test_purge_dry_run(self):
+        ''' A dry run deletes nothing.
+        '''
+        keys_before = self._list_keys()
+        with mock.patch.object(self.s3, 'delete_objects') as delete_objects:
+            self._purge(dry_run=True)
+        assert not delete_objects.called
+        assert self._list_keys() == keys_before
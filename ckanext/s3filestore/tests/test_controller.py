@@ -140,6 +140,55 @@ class TestS3Controller(object):
         status_code, location = self._get_expecting_redirect(resource_file_url)
         assert location == 'http://example'
 
+    def test_resource_download_private_dataset(self):
+        '''A resource in a private dataset cannot be downloaded
+        anonymously, even after it has been downloaded by an authorised
+        user, until the dataset is made public.'''
+        organization = factories.Organization()
+        dataset = factories.Dataset(owner_org=organization['id'], private=True)
+        resource = helpers.call_action(
+            'resource_create',
+            package_id=dataset['id'],
+            url='http://example')
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(dataset['id'], resource['id'])
+
+        app = helpers._get_test_app()
+        env = {'REMOTE_USER': six.ensure_str(self.sysadmin['name'])}
+        status_code, location = self._get_expecting_redirect(
+            resource_file_url, app=app, extra_environ=env)
+        assert location == 'http://example'
+        response = app.get(resource_file_url, expect_errors=True)
+        assert _get_status_code(response) in [401, 403]
+
+        helpers.call_action('package_patch', id=dataset['id'], private=False)
+        status_code, location = self._get_expecting_redirect(resource_file_url, app=app)
+        assert location == 'http://example'
+
+    def test_resource_download_other_dataset(self):
+        '''A resource cannot be downloaded via a dataset
+        that it does not belong to.'''
+        resource = self._upload_resource()
+        other_dataset = factories.Dataset()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(other_dataset['id'], resource['id'])
+
+        response = helpers._get_test_app().get(resource_file_url, expect_errors=True)
+        assert _get_status_code(response) == 404
+
+    def test_resource_download_deleted_resource(self):
+        '''A deleted resource cannot be downloaded,
+        even if it was downloaded just before.'''
+        resource = self._upload_resource()
+        resource_file_url = '/dataset/{0}/resource/{1}/download' \
+            .format(resource['package_id'], resource['id'])
+        app = helpers._get_test_app()
+        self._get_expecting_redirect(resource_file_url, app=app)
+
+        helpers.call_action('resource_delete', id=resource['id'])
+        response = app.get(resource_file_url, expect_errors=True)
+        assert _get_status_code(response) == 404
+
     def test_resource_download_url(self):
         u'''The resource url is expected for uploaded resource file.'''
         resource_with_upload = self._upload_resource()
@@ -189,13 +238,13 @@ class TestS3Controller(object):
 
     if toolkit.check_ckan_version('2.9'):
 
-        def _get_expecting_redirect(self, url, app=None):
+        def _get_expecting_redirect(self, url, app=None, extra_environ=None):
             if url.startswith('http:') or url.startswith('https:'):
                 site_url = config.get('ckan.site_url')
                 url = url.replace(site_url, '')
             if not app:
                 app = helpers._get_test_app()
-            response = app.get(url, follow_redirects=False)
+            response = app.get(url, follow_redirects=False, extra_environ=extra_environ)
             status_code = _get_status_code(response)
             assert status_code in [301, 302], \
                 "%s resulted in %s instead of a redirect" % (url, response.status)
@@ -244,13 +293,13 @@ class TestS3Controller(object):
 
     else:
 
-        def _get_expecting_redirect(self, url, app=None):
+        def _get_expecting_redirect(self, url, app=None, extra_environ=None):
             if url.startswith('http:') or url.startswith('https:'):
                 site_url = config.get('ckan.site_url')
                 url = url.replace(site_url, '')
             if not app:
                 app = helpers._get_test_app()
-            response = app.get(url)
+            response = app.get(url, extra_environ=extra_environ)
             status_code = _get_status_code(response)
             assert status_code in [301, 302], \
                 "%s resulted in %s instead of a redirect" % (url, response.status)
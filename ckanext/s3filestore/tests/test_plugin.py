@@ -43,11 +43,25 @@ class TestS3Plugin():
             mock_uploader = mock.MagicMock()
             with mock.patch('ckanext.s3filestore.plugin.get_resource_uploader') as mock_get_uploader:
                 mock_get_uploader.return_value = mock_uploader
-                mock_uploader.update_visibility = mock.MagicMock()
+                mock_uploader.update_package_visibility = mock.MagicMock()
 
                 self.plugin.after_update({}, pkg_dict)
-                mock_uploader.update_visibility.assert_called_once_with(
-                    'test-resource', target_acl=expected_acl)
+                mock_uploader.update_package_visibility.assert_called_once_with(
+                    [{'id': 'test-resource'}], target_acl=expected_acl)
+                mock_uploader.update_visibility.assert_not_called()
+
+    def test_package_after_update_without_batch_support(self):
+        ''' Uploaders without package-level updates are called per resource'''
+        pkg_dict = {'id': 'test-package', 'private': True,
+                    'resources': [{'id': 'test-resource'}, {'id': 'other-resource'}, {}]}
+        mock_uploader = mock.MagicMock(spec=['update_visibility'])
+        with mock.patch('ckanext.s3filestore.plugin.get_resource_uploader') as mock_get_uploader:
+            mock_get_uploader.return_value = mock_uploader
+
+            self.plugin.after_update_resource_list_update('private', 'test-package', pkg_dict)
+            mock_uploader.update_visibility.assert_has_calls([
+                mock.call('test-resource', target_acl='private'),
+                mock.call('other-resource', target_acl='private')])
 
     def test_enqueueing_visibility_update(self):
         ''' Asynchronous job is created to update object visibility.
@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+import datetime
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import boto3
+from botocore.client import Config
+import pytest
+
+from ckanext.s3filestore.presigner import S3Presigner, _sign
+
+NOW = datetime.datetime(2021, 6, 1, 12, 34, 56)
+
+
+def _get_client(endpoint_url=None, addressing_style='path',
+                signature_version='s3v4', token=None):
+    session = boto3.session.Session(
+        aws_access_key_id='AKIDEXAMPLE', aws_secret_access_key='secret/key+example',
+        aws_session_token=token, region_name='ap-southeast-2')
+    return session.client('s3', endpoint_url=endpoint_url, config=Config(
+        signature_version=signature_version, s3={'addressing_style': addressing_style}))
+
+
+def _compare_urls(client, key, params):
+    botocore_params = {'Bucket': 'my-bucket', 'Key': key}
+    botocore_params.update(params)
+    with mock.patch('botocore.auth.get_current_datetime', return_value=NOW), \
+            mock.patch('ckanext.s3filestore.presigner._get_current_datetime', return_value=NOW):
+        expected = client.generate_presigned_url(
+            ClientMethod='get_object', Params=botocore_params, ExpiresIn=3600)
+        actual = S3Presigner().generate_presigned_url(client, 'my-bucket', key, 3600, params)
+    assert actual == expected
+
+
+class TestS3Presigner():
+
+    @pytest.mark.parametrize('key', [
+        'my-path/resources/165900ba-3c60-43c5-9e9c-9f8acd0aa93f/data.csv',
+        'my-path/resources/abc/a b+c%20d~e!$&()=;,.csv',
+        u'my-path/resources/abc/déjà vu.csv',
+    ])
+    @pytest.mark.parametrize('params', [
+        {},
+        {'ResponseContentDisposition': 'attachment; filename=data.csv'},
+        {'ResponseContentType': 'text/csv', 'VersionId': 'a+b/c='},
+    ])
+    def test_urls_match_botocore(self, key, params):
+        ''' URLs are identical to those generated by botocore.
+        '''
+        _compare_urls(_get_client(), key, params)
+
+    @pytest.mark.parametrize('client_args', [
+        {'addressing_style': 'virtual'},
+        {'endpoint_url': 'http://localhost:9000'},
+        {'endpoint_url': 'https://s3.example.com:8443', 'addressing_style': 'auto'},
+        {'token': 'session/token+example'},
+        {'signature_version': 's3'},
+    ])
+    def test_urls_match_botocore_for_client_config(self, client_args):
+        ''' URLs are identical to those generated by botocore,
+        whatever the endpoint, addressing style, credentials and
+        signature version.
+        '''
+        _compare_urls(_get_client(**client_args), 'my-path/resources/abc/data.csv',
+                      {'ResponseContentDisposition': 'attachment; filename=data.csv'})
+
+    def test_signing_key_is_reused(self):
+        ''' The signing key is derived once per day, after which
+        each URL needs only one HMAC.
+        '''
+        client = _get_client()
+        presigner = S3Presigner()
+        with mock.patch('ckanext.s3filestore.presigner._get_current_datetime', return_value=NOW):
+            presigner.generate_presigned_url(client, 'my-bucket', 'a', 3600)
+            with mock.patch('ckanext.s3filestore.presigner._sign', wraps=_sign) as sign:
+                presigner.generate_presigned_url(client, 'my-bucket', 'b', 3600)
+        assert sign.call_count == 1
@@ -0,0 +1,129 @@
+# encoding: utf-8
+
+import json
+import time
+
+from ckanext.s3filestore.redis_helper import RedisHelper, LocalCache, \
+    INVALIDATION_CHANNEL
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+class TestRedisHelper():
+
+    def setup_method(self, test_method):
+        self.redis = RedisHelper()
+        self.redis.delete_many(['test/a', 'test/b', 'test/c'])
+
+    def test_get_many(self):
+        ''' Multiple values can be retrieved at once, in order.
+        '''
+        self.redis.put('test/a', 'first', expiry=60)
+        self.redis.put('test/c', 'third', expiry=60)
+        assert self.redis.get_many(['test/a', 'test/b', 'test/c']) == ['first', None, 'third']
+        assert self.redis.get_many([]) == []
+
+    def test_put_and_delete_many(self):
+        ''' Multiple values can be stored and deleted at once.
+        '''
+        self.redis.put_many({'test/a': 'first', 'test/b': 'second'}, expiry=60)
+        assert self.redis.get_many(['test/a', 'test/b']) == ['first', 'second']
+
+        self.redis.delete_many(['test/a', 'test/b'])
+        assert self.redis.get_many(['test/a', 'test/b']) == [None, None]
+
+    def test_put_many_without_expiry(self):
+        ''' Values without an expiry are not stored, as with 'put'.
+        '''
+        self.redis.put_many({'test/a': 'first'})
+        assert self.redis.get('test/a') is None
+
+    def test_batch_applies_operations_in_order(self):
+        ''' A batch applies its deletes and puts in the order given.
+        '''
+        self.redis.put('test/a', 'stale', expiry=60)
+        self.redis.put('test/b', 'stale', expiry=60)
+        with self.redis.batch() as batch:
+            batch.delete('test/a', 'test/b')
+            batch.put('test/b', 'fresh', expiry=60)
+            # nothing is sent until the batch is complete
+            assert self.redis.get('test/a') == 'stale'
+        assert self.redis.get_many(['test/a', 'test/b']) == [None, 'fresh']
+
+    def test_batch_publishes_one_invalidation(self):
+        ''' A batch tells other processes about all of its changes
+        in a single message.
+        '''
+        pubsub = self.redis._get_connection().pubsub()
+        pubsub.subscribe(INVALIDATION_CHANNEL)
+        assert pubsub.get_message(timeout=5)['type'] == 'subscribe'
+        with self.redis.batch() as batch:
+            batch.delete('test/a', 'test/b')
+            batch.put('test/b', 'fresh', expiry=60)
+            batch.delete('test/c')
+
+        messages = [pubsub.get_message(timeout=0.2) for _ in range(5)]
+        pubsub.close()
+        messages = [message for message in messages if message]
+        assert len(messages) == 1
+        assert json.loads(messages[0]['data'])['keys'] == ['test/a', 'test/b', 'test/c']
+
+    def test_local_cache_invalidated_by_other_processes(self):
+        ''' Values are served from process memory until
+        another process announces that they have changed.
+        '''
+        assert _wait_for(lambda: self.redis._get_local_cache() is not None)
+        self.redis.put('test/a', 'first', expiry=60)
+        assert self.redis.get('test/a') == 'first'
+        hits = self.redis.get_local_cache_stats()['hits']
+
+        # change the value behind the helper's back
+        connection = self.redis._get_connection()
+        connection.set(self.redis._get_cache_key('test/a'), 'second', ex=60)
+        assert self.redis.get('test/a') == 'first'
+        assert self.redis.get_local_cache_stats()['hits'] == hits + 1
+
+        connection.publish(INVALIDATION_CHANNEL, json.dumps({'origin': 'elsewhere', 'keys': ['test/a']}))
+        assert _wait_for(lambda: self.redis.get('test/a') == 'second')
+
+
+class TestLocalCache():
+
+    def test_least_recently_used_are_evicted(self):
+        ''' The least recently used entries make way for new ones.
+        '''
+        cache = LocalCache(max_size=2, max_age=60)
+        cache.put('a', 'first', expiry=60)
+        cache.put('b', 'second', expiry=60)
+        assert cache.get('a') == 'first'
+        cache.put('c', 'third', expiry=60)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == 'first'
+        assert cache.get('c') == 'third'
+        assert cache.get_stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2}
+
+    def test_entries_expire(self):
+        ''' Entries are held no longer than their expiry or the maximum age.
+        '''
+        short_expiry = LocalCache(max_size=10, max_age=60)
+        short_expiry.put('a', 'first', expiry=0.01)
+        short_max_age = LocalCache(max_size=10, max_age=0.01)
+        short_max_age.put('a', 'first', expiry=60)
+        time.sleep(0.02)
+        assert short_expiry.get('a') is None
+        assert short_max_age.get('a') is None
+
+    def test_outdated_values_are_not_stored(self):
+        ''' A value read before an invalidation is not stored after it.
+        '''
+        cache = LocalCache(max_size=10, max_age=60)
+        generation = cache.generation
+        cache.invalidate(['a'])
+        cache.put('a', 'stale', expiry=60, generation=generation)
+        assert cache.get('a') is None
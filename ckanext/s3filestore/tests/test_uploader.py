@@ -1,9 +1,13 @@
 # encoding: utf-8
 
 import datetime
+import hashlib
 import io
+import json
 import os
 import six
+import threading
+import time
 
 try:
     from unittest import mock
@@ -13,6 +17,7 @@ except ImportError:
 import pytest
 
 from botocore.exceptions import ClientError
+from botocore.paginate import Paginator
 
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
@@ -22,7 +27,8 @@ from ckan.tests import helpers
 import ckan.tests.factories as factories
 
 from ckanext.s3filestore.uploader import (
-    BaseS3Uploader, S3Uploader, S3ResourceUploader, _is_presigned_url)
+    BaseS3Uploader, S3Uploader, S3ResourceUploader, S3FileStoreException, _is_presigned_url,
+    METADATA_CACHE_PATH, PACKAGE_PRIVATE_CACHE_PATH, URL_LOCK_PATH, VISIBILITY_CACHE_PATH)
 
 from . import _get_status_code
 
@@ -71,6 +77,28 @@ class TestS3Uploader():
         uploader = S3Uploader('')
         assert uploader.get_s3_bucket(self.bucket_name)
 
+    def test_s3_client_is_pooled(self):
+        '''Uploaders share S3 clients rather than building new ones'''
+        client = BaseS3Uploader().get_s3_client()
+        assert S3Uploader('').get_s3_client() is client
+        assert S3ResourceUploader({'url': ''}).get_s3_client() is client
+
+    def test_s3_client_is_rebuilt_after_fork(self):
+        '''Pooled S3 clients are discarded in a forked child process'''
+        client = BaseS3Uploader().get_s3_client()
+        with mock.patch('ckanext.s3filestore.uploader.os.getpid', return_value=-1):
+            forked_client = BaseS3Uploader().get_s3_client()
+        assert forked_client is not client
+
+    def test_settings_are_shared(self):
+        '''Uploaders share settings until the config changes'''
+        settings = BaseS3Uploader().settings
+        assert S3ResourceUploader({'url': ''}).settings is settings
+        with mock.patch.dict(config, {'ckanext.s3filestore.signed_url_expiry': '60'}):
+            uploader = S3ResourceUploader({'url': ''})
+            assert uploader.settings is not settings
+            assert uploader.signed_url_expiry == 60
+
     def test_clean_dict(self):
         '''S3Uploader retrieves bucket as expected'''
         uploader = S3Uploader('')
@@ -218,6 +246,100 @@ class TestS3ResourceUploader():
         data = obj['Body'].read()
         assert data == io.open(file_path, 'rb').read()
 
+    def test_resource_upload_records_hash_and_size(self):
+        '''The hash and size of an uploaded file are recorded
+        on the resource and the S3 object'''
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        with io.open(file_path, 'rb') as upload_file:
+            data = upload_file.read()
+        resource = self._upload_test_resource()
+        assert resource['hash'] == hashlib.sha256(data).hexdigest()
+        assert resource['size'] == len(data)
+
+        metadata = self.s3.head_object(Bucket=self.bucket_name, Key=_get_object_key(resource))['Metadata']
+        assert metadata['sha256'] == resource['hash']
+        assert metadata['md5'] == hashlib.md5(data).hexdigest()
+
+    def test_resource_upload_over_max_size_is_rejected(self):
+        '''An upload over the size limit is stopped without
+        leaving an object or multipart upload in S3'''
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        uploader = S3ResourceUploader({'url': ''})
+        key = uploader.get_path('rejected-resource', 'data.csv')
+        with io.open(file_path, 'rb') as upload_file:
+            with pytest.raises(toolkit.ValidationError):
+                uploader.upload_to_key(key, upload_file, 'private', max_size=10)
+
+        with pytest.raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        assert not self.s3.list_multipart_uploads(Bucket=self.bucket_name).get('Uploads')
+
+    def test_resource_upload_without_extension_detects_type(self):
+        '''The type of an uploaded file with no extension
+        is detected from its content'''
+        file_path = os.path.join(os.path.dirname(__file__), 'example.docx')
+        resource = helpers.call_action(
+            'resource_create',
+            package_id=self._test_dataset()['id'],
+            upload=FlaskFileStorage(io.open(file_path, 'rb'), 'example'),
+            url='example')
+        assert resource['mimetype'] == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+    def test_resource_upload_from_staged_stream(self):
+        '''A file streamed to S3 as the request was received is
+        copied into place, then removed from the staging area'''
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        with io.open(file_path, 'rb') as upload_file:
+            data = upload_file.read()
+        staged = BaseS3Uploader().open_staged_upload()
+        staged.write(data)
+        staged.seek(0)
+        resource = helpers.call_action(
+            'resource_create',
+            package_id=self._test_dataset()['id'],
+            upload=FlaskFileStorage(staged, 'data.csv'),
+            url='data.csv')
+        assert resource['size'] == len(data)
+        assert resource['hash'] == hashlib.sha256(data).hexdigest()
+
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=_get_object_key(resource))
+        assert obj['ContentType'] == 'text/csv'
+        assert obj['Metadata']['package_id'] == resource['package_id']
+        assert obj['Body'].read() == data
+
+        staged.close()
+        with pytest.raises(ClientError):
+            self.s3.head_object(Bucket=self.bucket_name, Key=staged.key)
+
+    @helpers.change_config('ckanext.s3filestore.multipart_threshold', '1')
+    def test_resource_multipart_upload(self):
+        '''Test a resource file upload above the multipart threshold'''
+        file_path = os.path.join(os.path.dirname(__file__), 'data.csv')
+        resource = self._upload_test_resource()
+
+        obj = self.s3.get_object(Bucket=self.bucket_name, Key=_get_object_key(resource))
+        # multipart ETags are suffixed with the number of parts
+        assert obj['ETag'].endswith('-1"')
+        assert obj['ContentType'] == 'text/csv'
+        assert obj['ContentDisposition'] == 'attachment; filename=data.csv'
+        assert obj['Metadata']['package_id'] == resource['package_id']
+        assert obj['Body'].read() == io.open(file_path, 'rb').read()
+
+        # hashes are only known once the parts are sent, so they are tags
+        tags = self.s3.get_object_tagging(Bucket=self.bucket_name, Key=_get_object_key(resource))
+        assert {'Key': 'sha256', 'Value': resource['hash']} in tags['TagSet']
+
+    @helpers.change_config('ckanext.s3filestore.multipart_threshold', '1')
+    def test_failed_multipart_upload_is_aborted(self):
+        '''Test that a failed multipart upload does not leave parts behind'''
+        dataset = self._test_dataset()
+        error = ClientError({'Error': {'Code': '500'}}, 'UploadPart')
+        with mock.patch.object(self.s3, 'upload_part', side_effect=error):
+            with pytest.raises(ClientError):
+                self._upload_test_resource(dataset)
+
+        assert not self.s3.list_multipart_uploads(Bucket=self.bucket_name).get('Uploads')
+
     def test_package_update(self):
         ''' Test a typical package_update API call.
         '''
@@ -279,6 +401,164 @@ class TestS3ResourceUploader():
 
         _assert_private(resource, url, uploader)
 
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_resource_url_visibility_from_dataset(self):
+        ''' Tests that resource URL visibility is worked out
+        from the dataset, without reading object ACLs.
+        '''
+        public_resource = self._upload_test_resource()
+        private_dataset = factories.Dataset(private=True, owner_org=self.organisation['id'])
+        private_resource = self._upload_test_resource(private_dataset)
+
+        for resource, assert_visibility in [(public_resource, _assert_public),
+                                            (private_resource, _assert_private)]:
+            key = _get_object_key(resource)
+            uploader = S3ResourceUploader(resource)
+            client = uploader.get_s3_client()
+            uploader.redis.delete_many([key, key + VISIBILITY_CACHE_PATH,
+                                        resource['package_id'] + PACKAGE_PRIVATE_CACHE_PATH])
+
+            with mock.patch.object(client, 'get_object_acl') as get_object_acl:
+                url = uploader.get_signed_url_to_key(key)
+
+            assert not get_object_acl.called
+            assert_visibility(resource, url, uploader)
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_derived_public_url_is_cached_briefly(self):
+        ''' Tests that an unsigned URL is only cached for the signed URL
+        window while the object ACL is worked out from the dataset,
+        since the object may not have been made public yet.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        uploader.redis.delete_many([key, key + VISIBILITY_CACHE_PATH])
+
+        url = uploader.get_signed_url_to_key(key)
+        _assert_public(resource, url, uploader)
+        refresh_at = json.loads(uploader.redis.get(key))['refresh_at']
+        assert refresh_at <= time.time() + uploader.signed_url_cache_window
+
+    def test_public_url_served_while_refreshed(self):
+        ''' Tests that an unsigned URL for an object known to be public
+        is held in cache for longer than its refresh window, so that
+        it can be served while a replacement is generated.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        uploader.redis.delete(key)
+
+        url = uploader.get_signed_url_to_key(key)
+        _assert_public(resource, url, uploader)
+        refresh_at = json.loads(uploader.redis.get(key))['refresh_at']
+        assert refresh_at <= time.time() + uploader.public_url_cache_window
+        ttl = uploader.redis._get_connection().ttl(uploader.redis._get_cache_key(key))
+        assert ttl > uploader.public_url_cache_window
+
+    def test_resource_url_uses_cached_metadata(self):
+        ''' Tests that URLs for newly uploaded resources can be
+        generated without querying S3.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        client = uploader.get_s3_client()
+
+        with mock.patch.object(client, 'head_object') as head_object:
+            metadata = uploader.metadata(resource['id'])
+            uploader.redis.delete(key)
+            url = uploader.get_signed_url_to_key(key)
+
+        assert not head_object.called
+        assert metadata['content_type'] == 'text/csv'
+        assert metadata['hash'] == self.s3.head_object(Bucket=self.bucket_name, Key=key)['ETag']
+        assert 'ETag=' in url
+
+        uploader.clear_key(key)
+        with pytest.raises(toolkit.ObjectNotFound):
+            uploader.get_signed_url_to_key(key)
+
+    def test_concurrent_url_misses_are_coalesced(self):
+        ''' Tests that simultaneous requests for an uncached URL
+        only generate it once.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        client = uploader.get_s3_client()
+        uploader.redis.delete_many([key, key + METADATA_CACHE_PATH])
+
+        head_object = client.head_object
+
+        def slow_head_object(**kwargs):
+            time.sleep(0.2)
+            return head_object(**kwargs)
+
+        urls = []
+        with mock.patch.object(client, 'head_object', side_effect=slow_head_object) as mock_head:
+            threads = [threading.Thread(target=lambda: urls.append(uploader.get_signed_url_to_key(key)))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert mock_head.call_count == 1
+        assert len(urls) == 10
+        assert len(set(urls)) == 1
+
+    def test_url_misses_wait_for_lock_held_elsewhere(self):
+        ''' Tests that requests which miss while another process holds
+        the lock wait for it, rather than each generating the URL
+        once they tire of waiting.
+        '''
+        resource = self._upload_test_resource()
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        client = uploader.get_s3_client()
+        uploader.redis.delete_many([key, key + METADATA_CACHE_PATH])
+        # another process takes the lock and stalls until it expires
+        assert uploader.redis.acquire_lock(key + URL_LOCK_PATH, 1)
+
+        urls = []
+        with mock.patch('ckanext.s3filestore.uploader.URL_LOCK_EXPIRY', 1), \
+                mock.patch('ckanext.s3filestore.uploader.URL_WAIT_TIMEOUT', 0.2), \
+                mock.patch.object(client, 'head_object', wraps=client.head_object) as mock_head:
+            threads = [threading.Thread(target=lambda: urls.append(uploader.get_signed_url_to_key(key)))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert mock_head.call_count == 1
+        assert len(urls) == 10
+        assert len(set(urls)) == 1
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_stale_url_refreshed_in_background(self):
+        ''' Tests that a signed URL past its cache window is still
+        served while a replacement is generated.
+        '''
+        dataset = self._test_dataset(private=True)
+        resource = self._upload_test_resource(dataset)
+        key = _get_object_key(resource)
+        uploader = S3ResourceUploader(resource)
+        url = uploader.get_signed_url_to_key(key)
+
+        # make the URL due for refresh
+        uploader._cache_url(key, url, 0.01, 600)
+        time.sleep(0.02)
+        assert uploader._get_cached_url(key) == (url, False)
+
+        assert uploader.get_signed_url_to_key(key) == url
+        deadline = time.time() + 5
+        while not uploader._get_cached_url(key)[1] and time.time() < deadline:
+            time.sleep(0.05)
+        assert uploader._get_cached_url(key)[1]
+
     @helpers.change_config('ckanext.s3filestore.acl', 'auto')
     def test_making_dataset_private_updates_object_visibility(self):
         ''' Tests that a dataset that changes from public to private
@@ -405,6 +685,82 @@ class TestS3ResourceUploader():
         url = uploader.get_signed_url_to_key(key)
         assert _is_presigned_url(url), "Expected [{}] to use private URL but was {}".format(key, url)
 
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_update_visibility_reports_each_object(self):
+        ''' Tests that visibility updates report the outcome for
+        every object belonging to the resource.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        file_path = os.path.join(os.path.dirname(__file__), 'data.txt')
+        resource = helpers.call_action(
+            'resource_patch',
+            id=resource['id'],
+            upload=FlaskFileStorage(io.open(file_path, 'rb')),
+            url='data.txt')
+
+        uploader = S3ResourceUploader(resource)
+        actions = uploader.update_visibility(resource['id'], target_acl='private')
+        # the non-current object is already private
+        assert actions == {'unchanged': 1, 'updated': 1}
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_update_visibility_across_pages(self):
+        ''' Tests that visibility updates cover every page of objects.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        current_key = _get_object_key(resource)
+        for i in range(3):
+            self.s3.put_object(Bucket=self.bucket_name, ACL='public-read',
+                               Key='{}.{}'.format(current_key, i), Body=b'old')
+
+        # force one object per page
+        paginate = Paginator.paginate
+        with mock.patch.object(Paginator, 'paginate', side_effect=lambda self, **kwargs: paginate(
+                self, PaginationConfig={'PageSize': 1}, **kwargs)):
+            actions = uploader.update_visibility(resource['id'], target_acl='private')
+        assert actions == {'updated': 4}
+        for i in range(3):
+            url = uploader.get_signed_url_to_key('{}.{}'.format(current_key, i))
+            assert _is_presigned_url(url)
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_update_package_visibility(self):
+        ''' Tests that the objects of every resource in a package
+        are updated together.
+        '''
+        dataset = self._test_dataset(private=False)
+        resources = [self._upload_test_resource(dataset),
+                     self._upload_test_resource(dataset, 'data.txt')]
+        uploader = S3ResourceUploader(resources[0])
+
+        actions = uploader.update_package_visibility(resources, target_acl='private')
+        assert actions == {'updated': 2}
+        for resource in resources:
+            url = uploader.get_signed_url_to_key(uploader.get_path(resource['id'], resource['url']))
+            _assert_private(resource, url, uploader)
+
+        # visibility is now cached as up to date
+        assert not uploader.update_package_visibility(resources, target_acl='private')
+
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    def test_update_visibility_failure(self):
+        ''' Tests that a failure to update an object ACL is reported.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+
+        error = ClientError({'Error': {'Code': '403'}}, 'PutObjectAcl')
+        with mock.patch.object(self.s3, 'put_object_acl', side_effect=error):
+            with pytest.raises(S3FileStoreException):
+                uploader.update_visibility(resource['id'], target_acl='private')
+
+        url = uploader.get_signed_url_to_key(_get_object_key(resource))
+        _assert_public(resource, url, uploader)
+
     @helpers.change_config('ckanext.s3filestore.acl', 'auto')
     @helpers.change_config('ckanext.s3filestore.delete_non_current_days', '0')
     def test_delete_non_current_objects_after_expiry(self):
@@ -429,6 +785,41 @@ class TestS3ResourceUploader():
         with pytest.raises(toolkit.ObjectNotFound):
             assert uploader.get_signed_url_to_key(key) is not None
 
+    @helpers.change_config('ckanext.s3filestore.acl', 'auto')
+    @helpers.change_config('ckanext.s3filestore.delete_non_current_days', '0')
+    def test_delete_non_current_objects_in_batches(self):
+        ''' Tests that expired objects are deleted in batches,
+        and that an object which cannot be deleted is reported.
+        '''
+        dataset = self._test_dataset(private=False)
+        resource = self._upload_test_resource(dataset)
+        uploader = S3ResourceUploader(resource)
+        old_keys = [uploader.get_path(resource['id'], 'old-{}.csv'.format(i)) for i in range(5)]
+        for key in old_keys:
+            self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=b'old')
+
+        delete_objects = self.s3.delete_objects
+
+        def fail_one(**kwargs):
+            objects = kwargs['Delete']['Objects']
+            if objects[0]['Key'] != old_keys[0]:
+                return delete_objects(**kwargs)
+            kwargs['Delete']['Objects'] = objects[1:]
+            response = delete_objects(**kwargs)
+            response['Errors'] = [{'Key': old_keys[0], 'Code': 'AccessDenied', 'Message': 'Denied'}]
+            return response
+
+        with mock.patch('ckanext.s3filestore.visibility.DELETE_OBJECTS_BATCH_SIZE', 2), \
+                mock.patch.object(self.s3, 'delete_objects', side_effect=fail_one) as mock_delete:
+            with pytest.raises(S3FileStoreException) as error:
+                uploader.update_visibility(resource['id'], target_acl='private')
+        assert mock_delete.call_count == 3
+        assert old_keys[0] in str(error.value)
+        remaining = [upload['Key'] for upload in self.s3.list_objects_v2(
+            Bucket=self.bucket_name, Prefix=uploader.get_directory(resource['id'], uploader.storage_path)
+        )['Contents']]
+        assert sorted(remaining) == sorted([old_keys[0], _get_object_key(resource)])
+
     @helpers.change_config('ckanext.s3filestore.acl', 'auto')
     @helpers.change_config('ckanext.s3filestore.delete_non_current_days', '2')
     def test_do_not_delete_non_current_objects_before_expiry(self):
@@ -1,7 +1,9 @@
 # encoding: utf-8
 
+from collections import Counter, namedtuple
 import datetime
 import errno
+import json
 import logging
 import mimetypes
 import magic
@@ -9,7 +11,11 @@ import os
 import pytz as timezone
 import re
 import six
+import threading
+import time
+import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.client import Config
@@ -23,6 +29,10 @@ from ckan.lib.uploader import ResourceUpload as DefaultResourceUpload, Upload as
 from ckan import model
 from ckan.plugins.toolkit import g
 
+from ckanext.s3filestore.multipart import MultipartWriter, HashingReader, StagedUpload, UploadTooLarge, \
+    DEFAULT_MULTIPART_THRESHOLD, DEFAULT_MULTIPART_PART_SIZE, DEFAULT_MULTIPART_CONCURRENCY, \
+    MAX_PARTS, MB, MIN_PART_SIZE
+from ckanext.s3filestore.presigner import presigner
 from ckanext.s3filestore.redis_helper import RedisHelper
 
 if toolkit.check_ckan_version(min_version='2.8'):
@@ -44,8 +54,35 @@ _max_image_size = None
 
 URL_HOST = re.compile('^https?://[^/]*/')
 VISIBILITY_CACHE_PATH = '/visibility'
+METADATA_CACHE_PATH = '/metadata'
+# package visibility, cached by the plugin when a package is updated
+PACKAGE_PRIVATE_CACHE_PATH = '/private'
+# resource fields and authorisation checks for the download view
+DOWNLOAD_CACHE_PATH = '/download'
+URL_LOCK_PATH = '/lock'
+# seconds that one process may spend generating a URL before others join in
+URL_LOCK_EXPIRY = 10
+# seconds that threads wait for another thread in the same process to
+# generate a URL; longer than it may wait for another process to do so
+URL_WAIT_TIMEOUT = 15
+URL_WAIT_INTERVAL = 0.05
+# cached signed URLs are not served once they have less validity than this
+SIGNED_URL_MIN_VALIDITY = 60
+# cached public URLs are served, while being refreshed, until this many
+# times their cache window has passed
+PUBLIC_URL_EXPIRY_FACTOR = 2
+URL_REFRESH_WORKERS = 2
+# object attributes from HeadObject that are held in cache
+CACHED_METADATA_FIELDS = ('ContentType', 'ContentLength', 'ETag', 'LastModified')
 PUBLIC_ACL = 'public-read'
 PRIVATE_ACL = 'private'
+DEFAULT_ACL_CONCURRENCY = 8
+# the most keys that S3 will delete in one DeleteObjects request
+DELETE_OBJECTS_BATCH_SIZE = 1000
+# uploads being received are streamed to here, under the storage path
+STAGING_PATH = 'staging'
+# botocore's default connection pool size
+DEFAULT_MAX_POOL_CONNECTIONS = 10
 
 
 def _get_underlying_file(wrapper):
@@ -64,12 +101,110 @@ def ensure_ascii(text):
     return text.encode('ascii', 'xmlcharrefreplace').decode()
 
 
+def _get_upload_fields(object_args, acl_field):
+    ''' Convert PutObject parameters to the form fields of a presigned
+    POST (`acl_field` 'acl') or the headers of a presigned PUT
+    (`acl_field` 'x-amz-acl').
+    '''
+    fields = {acl_field: object_args['ACL'], 'Content-Type': object_args['ContentType']}
+    if 'ContentDisposition' in object_args:
+        fields['Content-Disposition'] = object_args['ContentDisposition']
+    for name, value in six.iteritems(object_args.get('Metadata') or {}):
+        fields['x-amz-meta-' + name] = value
+    return fields
+
+
 def _get_object_age_days(upload):
     """ Calculates the age of an uploaded S3 object, in days, rounded down.
     """
     return (datetime.datetime.now(timezone.utc) - upload['LastModified']).days
 
 
+# The config options used by uploaders, with their defaults and
+# how to convert them, in the order of the S3Settings fields.
+_SETTINGS_OPTIONS = (
+    ('bucket_name', 'aws_bucket_name', None, None),
+    ('region', 'region_name', None, None),
+    ('signature', 'signature_version', None, None),
+    ('download_proxy', 'download_proxy', None, None),
+    ('signed_url_expiry', 'signed_url_expiry', '3600', int),
+    ('signed_url_cache_window', 'signed_url_cache_window', '1800', int),
+    ('public_url_cache_window', 'public_url_cache_window', '86400', int),
+    ('acl_cache_window', 'acl_cache_window', '86400', int),
+    ('metadata_cache_window', 'metadata_cache_window', '86400', int),
+    ('acl', 'acl', PUBLIC_ACL, None),
+    ('non_current_acl', 'non_current_acl', PRIVATE_ACL, None),
+    ('verify_acl', 'acl.verify', False, toolkit.asbool),
+    ('addressing_style', 'addressing_style', 'auto', None),
+    ('host_name', 'host_name', None, None),
+    ('multipart_threshold', 'multipart_threshold', DEFAULT_MULTIPART_THRESHOLD, int),
+    ('multipart_part_size', 'multipart_part_size', DEFAULT_MULTIPART_PART_SIZE, int),
+    ('multipart_concurrency', 'multipart_concurrency', DEFAULT_MULTIPART_CONCURRENCY, int),
+    ('acl_concurrency', 'acl.concurrency', DEFAULT_ACL_CONCURRENCY, int),
+    ('aws_storage_path', 'aws_storage_path', '', None),
+    ('use_filename', 'use_filename', False, toolkit.asbool),
+    ('delete_non_current_days', 'delete_non_current_days', '-1', int),
+    ('upload_url_expiry', 'upload_url_expiry', '3600', int),
+)
+_SETTINGS_KEYS = tuple('ckanext.s3filestore.' + option[1] for option in _SETTINGS_OPTIONS)
+
+S3Settings = namedtuple('S3Settings', [option[0] for option in _SETTINGS_OPTIONS])
+
+_settings = None
+
+
+def get_settings():
+    """ Return the S3Settings for the current config.
+
+    Settings are parsed once and shared by every uploader. The raw
+    values are compared on each call, which is far cheaper than
+    parsing them, so that settings are recomputed if the config is
+    reloaded or changed.
+    """
+    global _settings
+    raw_values = tuple(config.get(key) for key in _SETTINGS_KEYS)
+    cached = _settings
+    if cached is not None and cached[0] == raw_values:
+        return cached[1]
+
+    values = []
+    for (name, option, default, converter), raw_value in zip(_SETTINGS_OPTIONS, raw_values):
+        value = default if raw_value is None else raw_value
+        if converter is not None and value is not None:
+            value = converter(value)
+        values.append(value)
+    settings = S3Settings(*values)
+    if settings.host_name is None:
+        # Fall back to standard endpoint if not specified.
+        # NB Boto will automatically add bucket name and key to the endpoint,
+        # according to the addressing style in use.
+        settings = settings._replace(host_name='https://s3.{}.amazonaws.com'.format(settings.region))
+    _settings = (raw_values, settings)
+    return settings
+
+
+class _MimeDetector(object):
+    ''' A libmagic handle shared by every uploader.
+
+    Loading the magic database is expensive, so it is only done
+    when a file type is first detected. libmagic handles are not
+    thread-safe, so detection is serialised.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._magic = None
+
+    def from_buffer(self, buffer):
+        with self._lock:
+            if self._magic is None:
+                self._magic = magic.Magic(mime=True)
+            return self._magic.from_buffer(buffer)
+
+
 class S3FileStoreException(Exception):
     pass
 
@@ -87,6 +222,207 @@ def get_s3_session(config):
                                  region_name=region)
 
 
+class _S3ClientRegistry(object):
+    ''' Process-wide cache of boto3 sessions and clients.
+
+    Building a session and client loads the botocore service models
+    and sets up a fresh connection pool, which is far more expensive
+    than the API calls we make with them. Sessions are shared per set
+    of credentials, and clients per (endpoint, signature version,
+    addressing style). Clients are thread-safe; resources are not,
+    so those are held per thread.
+
+    Everything is discarded when the process ID changes, so that
+    worker processes forked by uwsgi/gunicorn build their own
+    connections instead of sharing sockets with the parent.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._sessions = {}
+        self._clients = {}
+        self._local = threading.local()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            log.debug("Process ID has changed; discarding pooled S3 clients")
+            self.reset()
+
+    def _get_session_key(self, config):
+        if toolkit.asbool(config.get('ckanext.s3filestore.aws_use_ami_role', False)):
+            credentials = (None, None)
+        else:
+            credentials = (config.get('ckanext.s3filestore.aws_access_key_id'),
+                           config.get('ckanext.s3filestore.aws_secret_access_key'))
+        return credentials + (config.get('ckanext.s3filestore.region_name'),)
+
+    def _get_session(self, session_key):
+        # caller must hold the lock
+        session = self._sessions.get(session_key)
+        if session is None:
+            session = get_s3_session(config)
+            self._sessions[session_key] = session
+        return session
+
+    def get_client(self, endpoint_url, signature_version, addressing_style):
+        self._check_fork()
+        client_key = self._get_session_key(config) + (
+            endpoint_url, signature_version, addressing_style)
+        client = self._clients.get(client_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(client_key)
+                if client is None:
+                    log.debug("Creating pooled S3 client for %s", endpoint_url)
+                    session = self._get_session(client_key[:3])
+                    client = session.client(
+                        's3', endpoint_url=endpoint_url,
+                        config=_get_s3_config(signature_version, addressing_style))
+                    self._clients[client_key] = client
+        return client
+
+    def get_resource(self, endpoint_url, signature_version, addressing_style):
+        self._check_fork()
+        resource_key = self._get_session_key(config) + (
+            endpoint_url, signature_version, addressing_style)
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+        resource = resources.get(resource_key)
+        if resource is None:
+            with self._lock:
+                session = self._get_session(resource_key[:3])
+                resource = session.resource(
+                    's3', endpoint_url=endpoint_url,
+                    config=_get_s3_config(signature_version, addressing_style))
+            resources[resource_key] = resource
+        return resource
+
+
+class _SingleFlight(object):
+    ''' Coalesces concurrent calls for the same key within a process,
+    so that one thread does the work and the others share its outcome.
+    '''
+
+    class _Call(object):
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def run(self, key, function, timeout=None, recheck=None):
+        ''' Call `function`, unless another thread is already calling
+        it for `key`, in which case wait up to `timeout` seconds
+        (default URL_WAIT_TIMEOUT) for that call to finish and return
+        its result (or raise its error).
+
+        If it takes longer than that, return the result of `recheck`,
+        if specified and not None, or else call `function` independently.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            if not call.event.wait(URL_WAIT_TIMEOUT if timeout is None else timeout):
+                result = recheck() if recheck else None
+                if result is not None:
+                    return result
+            if call.event.is_set():
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            log.debug("Timed out waiting for %s; proceeding independently", key)
+            return function()
+        try:
+            call.result = function()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class _BackgroundRefresher(object):
+    ''' Runs refreshes of cached values on a small thread pool,
+    at most one per key at a time.
+    '''
+
+    def __init__(self, max_workers=URL_REFRESH_WORKERS):
+        self.max_workers = max_workers
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+
+    def refresh(self, key, function):
+        ''' Call `function` in the background, unless a refresh
+        of `key` is already pending.
+        '''
+        with self._lock:
+            if key in self._pending:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._pending.add(key)
+            try:
+                self._executor.submit(self._run, key, function)
+            except Exception:
+                self._pending.discard(key)
+                raise
+
+    def _run(self, key, function):
+        try:
+            function()
+        except Exception as e:
+            log.warning("Failed to refresh %s in the background: %s", key, e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+            # release any database connection used by this thread
+            model.Session.remove()
+
+
+_client_registry = _S3ClientRegistry()
+_url_flights = _SingleFlight()
+_url_refresher = _BackgroundRefresher()
+_mime_detector = _MimeDetector()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_client_registry.reset)
+    os.register_at_fork(after_in_child=_url_flights.reset)
+    os.register_at_fork(after_in_child=_url_refresher.reset)
+    os.register_at_fork(after_in_child=_mime_detector.reset)
+
+
+def _get_s3_config(signature_version, addressing_style):
+    # allow enough connections for all of our concurrent operations
+    settings = get_settings()
+    max_pool_connections = max(
+        DEFAULT_MAX_POOL_CONNECTIONS, settings.acl_concurrency, settings.multipart_concurrency)
+    return Config(
+        signature_version=signature_version,
+        s3={'addressing_style': addressing_style},
+        max_pool_connections=max_pool_connections
+    )
+
+
 def _is_presigned_url(url):
     ''' Determines whether a URL represents a presigned S3 URL.'''
     parts = url.split('?')
@@ -96,22 +432,26 @@ def _is_presigned_url(url):
 class BaseS3Uploader(object):
 
     def __init__(self):
-        self.bucket_name = config.get('ckanext.s3filestore.aws_bucket_name')
-        self.region = config.get('ckanext.s3filestore.region_name')
-        self.signature = config.get('ckanext.s3filestore.signature_version')
-        self.download_proxy = config.get('ckanext.s3filestore.download_proxy')
-        self.signed_url_expiry = int(config.get('ckanext.s3filestore.signed_url_expiry', '3600'))
-        self.signed_url_cache_window = int(config.get('ckanext.s3filestore.signed_url_cache_window', '1800'))
-        self.public_url_cache_window = int(config.get('ckanext.s3filestore.public_url_cache_window', '86400'))
-        self.acl_cache_window = int(config.get('ckanext.s3filestore.acl_cache_window', '86400'))
-        self.acl = config.get('ckanext.s3filestore.acl', PUBLIC_ACL)
-        self.non_current_acl = config.get('ckanext.s3filestore.non_current_acl', PRIVATE_ACL)
-        self.addressing_style = config.get('ckanext.s3filestore.addressing_style', 'auto')
-        # Fall back to standard endpoint if not specified.
-        # NB Boto will automatically add bucket name and key to the endpoint,
-        # according to the addressing style in use.
-        self.host_name = config.get('ckanext.s3filestore.host_name',
-                                    'https://s3.{}.amazonaws.com'.format(self.region))
+        settings = get_settings()
+        self.settings = settings
+        self.bucket_name = settings.bucket_name
+        self.region = settings.region
+        self.signature = settings.signature
+        self.download_proxy = settings.download_proxy
+        self.signed_url_expiry = settings.signed_url_expiry
+        self.signed_url_cache_window = settings.signed_url_cache_window
+        self.public_url_cache_window = settings.public_url_cache_window
+        self.acl_cache_window = settings.acl_cache_window
+        self.metadata_cache_window = settings.metadata_cache_window
+        self.acl = settings.acl
+        self.non_current_acl = settings.non_current_acl
+        # check visibility worked out from other sources against S3
+        self.verify_acl = settings.verify_acl
+        self.addressing_style = settings.addressing_style
+        self.host_name = settings.host_name
+        self.multipart_threshold = settings.multipart_threshold
+        self.multipart_part_size = settings.multipart_part_size
+        self.multipart_concurrency = settings.multipart_concurrency
         self.redis = RedisHelper()
 
     def get_directory(self, id, storage_path):
@@ -119,21 +459,26 @@ class BaseS3Uploader(object):
         return directory
 
     def _get_s3_config(self):
-        return Config(
-            signature_version=self.signature,
-            s3={'addressing_style': self.addressing_style}
-        )
+        return _get_s3_config(self.signature, self.addressing_style)
 
     def get_s3_resource(self, session=None):
+        ''' Return an S3 resource. If no session is specified,
+        a pooled resource for the current thread is reused.
+        '''
         if not session:
-            session = get_s3_session(config)
+            return _client_registry.get_resource(
+                self.host_name, self.signature, self.addressing_style)
         return session.resource('s3',
                                 endpoint_url=self.host_name,
                                 config=self._get_s3_config())
 
     def get_s3_client(self, session=None):
+        ''' Return an S3 client. If no session is specified,
+        a pooled client shared across the process is reused.
+        '''
         if not session:
-            session = get_s3_session(config)
+            return _client_registry.get_client(
+                self.host_name, self.signature, self.addressing_style)
         return session.client('s3',
                               endpoint_url=self.host_name,
                               config=self._get_s3_config())
@@ -173,65 +518,309 @@ class BaseS3Uploader(object):
 
         return bucket
 
-    def upload_to_key(self, filepath, upload_file, acl, extra_metadata=None):
-        '''Uploads the `upload_file` to `filepath` on `self.bucket`.'''
+    def iter_object_pages(self, prefix, client=None):
+        ''' Generate the S3 objects under a prefix, one page at a time.
 
-        upload_file.seek(0)
-        mime_type = getattr(self, 'mimetype', '') or 'application/octet-stream'
-        log.debug(
-            "ckanext.s3filestore.uploader: going to upload [%s] to bucket [%s] "
-            "with access [%s] and mimetype [%s]",
-            filepath, self.bucket_name, acl, mime_type)
+        Each page is a list of up to 1000 object summaries, as found in
+        the 'Contents' of 'list_objects_v2'. Pages are only requested
+        as they are consumed.
+        '''
+        if not client:
+            client = self.get_s3_client()
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            if page.get('Contents'):
+                yield page['Contents']
+
+    def get_upload_writer(self, filepath, acl, mime_type, extra_metadata=None,
+                          expected_size=None, client=None):
+        ''' Return a MultipartWriter that will stream data to `filepath`,
+        with the same object settings that `upload_to_key` uses.
+        '''
+        return MultipartWriter(
+            client or self.get_s3_client(), self.bucket_name, filepath,
+            threshold=self.multipart_threshold,
+            part_size=self.multipart_part_size,
+            max_concurrency=self.multipart_concurrency,
+            expected_size=expected_size,
+            **self._get_object_args(filepath, acl, mime_type, extra_metadata))
+
+    def _get_object_args(self, filepath, acl, mime_type, extra_metadata=None):
+        ''' Return the PutObject parameters for an upload to `filepath`,
+        ie its ACL, ContentType, ContentDisposition and Metadata.
+        '''
+        kwargs = {'ACL': acl, 'ContentType': mime_type}
+        if mime_type != 'application/pdf':
+            filename = filepath.split('/')[-1]
+            kwargs['ContentDisposition'] = 'attachment; filename=' + filename
+        if extra_metadata:
+            kwargs['Metadata'] = extra_metadata
+        return kwargs
+
+    def upload_to_key(self, filepath, upload_file, acl, extra_metadata=None, max_size=None):
+        '''Uploads the `upload_file` to `filepath` on `self.bucket`.
+
+        The file is streamed to S3, using a multipart upload if it is
+        larger than the configured threshold, so it is never held
+        in memory all at once. Each chunk is read once, and is used to
+        detect the content type (from the first chunk), hash and count
+        the data as well as being sent to S3.
+
+        Objects sent in a single request carry their MD5 and SHA-256
+        hashes as metadata. Multipart uploads must declare their
+        metadata before the hashes are known, so the hashes are added
+        as object tags instead, rather than copying the object again.
+
+        If `max_size` (in bytes) is set and the file is larger, a
+        ValidationError is raised; the upload stops as soon as the
+        limit is passed, and any multipart upload is aborted.
+
+        If `upload_file` is a StagedUpload, its data is already in S3,
+        so the staging object is copied to `filepath` within S3 instead.
+
+        Returns the HashingReader, describing the data uploaded.
+        '''
 
+        expected_size = getattr(self, 'filesize', None)
         try:
-            kwargs = {
-                'Body': upload_file.read(), 'ACL': acl,
-                'ContentType': mime_type}
-            if mime_type != 'application/pdf':
-                filename = filepath.split('/')[-1]
-                kwargs['ContentDisposition'] = 'attachment; filename=' + filename
-            if extra_metadata:
-                kwargs['Metadata'] = extra_metadata
-
-            self.get_s3_resource().Object(self.bucket_name, filepath).put(**kwargs)
+            if isinstance(upload_file, StagedUpload):
+                return self._copy_staged_upload(filepath, upload_file, acl, extra_metadata, max_size)
+            if max_size is not None and expected_size and expected_size > max_size:
+                raise UploadTooLarge("Upload of {} bytes exceeds the limit of {} bytes".format(
+                    expected_size, max_size))
+            upload_file.seek(0)
+            reader = HashingReader(upload_file, self.multipart_part_size, max_size)
+            chunks = iter(reader)
+            first_chunk = next(chunks, b'')
+            mime_type = self._get_upload_mimetype(first_chunk)
+            log.debug(
+                "ckanext.s3filestore.uploader: going to upload [%s] to bucket [%s] "
+                "with access [%s] and mimetype [%s]",
+                filepath, self.bucket_name, acl, mime_type)
+
+            with self.get_upload_writer(
+                    filepath, acl, mime_type, extra_metadata, expected_size=expected_size) as writer:
+                writer.write(first_chunk)
+                for chunk in chunks:
+                    writer.write(chunk)
+                hashes = {'md5': reader.md5, 'sha256': reader.sha256}
+                hashes_in_metadata = writer.add_metadata(hashes)
+            if not hashes_in_metadata:
+                self._tag_object(filepath, hashes)
             log.info("Successfully uploaded %s to S3!", filepath)
-            self.redis.delete(filepath)
-            self.redis.delete(filepath + VISIBILITY_CACHE_PATH + '/all')
-            self.redis.put(filepath + VISIBILITY_CACHE_PATH, acl, expiry=self.acl_cache_window)
+            # S3 does not return the modification time, so this is approximate
+            self._cache_upload(filepath, acl, {
+                'ContentType': mime_type,
+                'ContentLength': reader.size,
+                'ETag': writer.response['ETag'],
+                'LastModified': datetime.datetime.now(timezone.utc),
+            })
+        except UploadTooLarge as e:
+            log.info("Rejected upload to [%s]: %s", filepath, e)
+            raise toolkit.ValidationError({'upload': ['File upload too large']})
         except Exception as e:
             log.error('Something went very very wrong when uploading to [%s]: %s', filepath, e)
             raise e
+        return reader
 
-    def clear_key(self, filepath):
-        '''Deletes the contents of the key at `filepath` on `self.bucket`.'''
+    def _tag_object(self, filepath, tags):
+        ''' Add tags to an S3 object. Failure is logged rather than
+        raised, since the object itself has been uploaded.
+        '''
+        try:
+            self.get_s3_client().put_object_tagging(
+                Bucket=self.bucket_name, Key=filepath,
+                Tagging={'TagSet': [{'Key': name, 'Value': value} for name, value in sorted(tags.items())]})
+        except Exception as e:
+            log.warning("Failed to tag %s with %s: %s", filepath, ', '.join(sorted(tags)), e)
+
+    def open_staged_upload(self, max_size=None):
+        ''' Return a StagedUpload that streams whatever is written to it
+        to a new staging object, for `upload_to_key` to copy into place.
+        If more than `max_size` bytes are written, UploadTooLarge is raised.
+        '''
+        key = os.path.join(self.settings.aws_storage_path, STAGING_PATH, uuid.uuid4().hex)
+        return StagedUpload(
+            self.get_upload_writer(key, PRIVATE_ACL, 'application/octet-stream'), max_size)
+
+    def _copy_staged_upload(self, filepath, staged, acl, extra_metadata=None, max_size=None):
+        ''' Copy a StagedUpload to `filepath` within S3, with the settings
+        and hash metadata that `upload_to_key` would give it.
+        '''
+        staged.finish()
+        if max_size is not None and staged.size > max_size:
+            raise UploadTooLarge("Upload of {} bytes exceeds the limit of {} bytes".format(
+                staged.size, max_size))
+        reader = staged.hasher
+        mime_type = self._get_upload_mimetype(staged.head)
+        metadata = dict(extra_metadata or {}, md5=reader.md5, sha256=reader.sha256)
+        log.debug(
+            "ckanext.s3filestore.uploader: going to copy [%s] to [%s] in bucket [%s] "
+            "with access [%s] and mimetype [%s]",
+            staged.key, filepath, self.bucket_name, acl, mime_type)
+
+        client = self.get_s3_client()
+        object_args = self._get_object_args(filepath, acl, mime_type, metadata)
+        # uses a multipart copy for large objects
+        client.copy(
+            {'Bucket': staged.bucket_name, 'Key': staged.key}, self.bucket_name, filepath,
+            ExtraArgs=dict(object_args, MetadataDirective='REPLACE'))
+        log.info("Successfully uploaded %s to S3!", filepath)
+        self._cache_upload(filepath, acl, client.head_object(Bucket=self.bucket_name, Key=filepath))
+        return reader
+
+    def _cache_upload(self, filepath, acl, metadata):
+        ''' Replace anything cached about `filepath` with the ACL
+        and metadata of a new upload.
+        '''
+        with self.redis.batch() as cache:
+            cache.delete(filepath, filepath + VISIBILITY_CACHE_PATH + '/all')
+            cache.put(filepath + VISIBILITY_CACHE_PATH, acl, expiry=self.acl_cache_window)
+            self._cache_key_metadata(filepath, metadata, cache)
+
+    def _get_upload_mimetype(self, head):
+        ''' Return the content type for an upload, given its first chunk.
+        '''
+        return getattr(self, 'mimetype', '') or 'application/octet-stream'
+
+    def clear_key(self, filepath, cache=None):
+        '''Deletes the contents of the key at `filepath` on `self.bucket`.
+
+        If `cache` is a Redis batch, cache invalidation is added to it
+        instead of being sent immediately.
+        '''
         try:
             self.get_s3_resource().Object(self.bucket_name, filepath).delete()
             log.info("Removed %s from S3", filepath)
-            self.redis.delete(filepath)
-            self.redis.delete(filepath + VISIBILITY_CACHE_PATH)
+            cache_keys = (filepath, filepath + VISIBILITY_CACHE_PATH, filepath + METADATA_CACHE_PATH)
+            if cache is not None:
+                cache.delete(*cache_keys)
+            else:
+                self.redis.delete_many(cache_keys)
         except Exception as e:
             raise e
 
+    def clear_keys(self, filepaths, cache=None, client=None):
+        '''Deletes the keys at `filepaths` on `self.bucket`,
+        up to DELETE_OBJECTS_BATCH_SIZE keys per request.
+
+        Cache invalidation for each request is sent in one pipeline,
+        or added to `cache` if it is a Redis batch.
+
+        Returns a dict of the keys that could not be deleted
+        to the errors that prevented it.
+        '''
+        if not client:
+            client = self.get_s3_client()
+        filepaths = list(filepaths)
+        failures = {}
+        for start in range(0, len(filepaths), DELETE_OBJECTS_BATCH_SIZE):
+            batch_paths = filepaths[start:start + DELETE_OBJECTS_BATCH_SIZE]
+            try:
+                response = client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': path} for path in batch_paths], 'Quiet': True})
+            except Exception as e:
+                log.error("Failed to remove %s objects from S3: %s", len(batch_paths), e)
+                failures.update((path, e) for path in batch_paths)
+                continue
+
+            batch_failures = {}
+            for error in response.get('Errors', []):
+                log.error("Failed to remove %s from S3: %s %s",
+                          error['Key'], error.get('Code'), error.get('Message'))
+                batch_failures[error['Key']] = S3FileStoreException(
+                    "{}: {}".format(error.get('Code'), error.get('Message')))
+            failures.update(batch_failures)
+
+            deleted = [path for path in batch_paths if path not in batch_failures]
+            log.info("Removed %s objects from S3", len(deleted))
+            cache_keys = [cache_key for path in deleted for cache_key in
+                          (path, path + VISIBILITY_CACHE_PATH, path + METADATA_CACHE_PATH)]
+            if cache is not None:
+                cache.delete(*cache_keys)
+            else:
+                self.redis.delete_many(cache_keys)
+        return failures
+
+    def _get_key_acl(self, key, client=None):
+        ''' Retrieve the effective ACL of an S3 object from S3,
+        either PUBLIC_ACL or PRIVATE_ACL.
+        '''
+        if not client:
+            client = self.get_s3_client()
+        # check if the object ACL grants any permission to all users
+        return PUBLIC_ACL if any(
+            grant['Grantee']['Type'] == 'Group'
+            and grant['Grantee'].get('URI', '').endswith('AllUsers')
+            for grant in client.get_object_acl(Bucket=self.bucket_name, Key=key)['Grants']
+        ) else PRIVATE_ACL
+
+    def get_key_metadata(self, key, client=None):
+        ''' Retrieve the ContentType, ContentLength, ETag and LastModified
+        of an S3 object. May cache results to reduce API calls.
+
+        LastModified is an ISO 8601 string.
+        Raises ClientError if the object cannot be found.
+        '''
+        cached_metadata = self.redis.get(key + METADATA_CACHE_PATH)
+        if cached_metadata:
+            try:
+                return json.loads(cached_metadata)
+            except ValueError:
+                log.warning("Discarding invalid cached metadata for %s", key)
+
+        if not client:
+            client = self.get_s3_client()
+        metadata = client.head_object(Bucket=self.bucket_name, Key=key)
+        return self._cache_key_metadata(key, metadata)
+
+    def _cache_key_metadata(self, key, metadata, cache=None):
+        ''' Store the cacheable fields of `metadata` for `key`,
+        either immediately or in the Redis batch `cache`.
+        '''
+        metadata = self.as_clean_dict(
+            {field: metadata[field] for field in CACHED_METADATA_FIELDS if field in metadata})
+        (cache or self.redis).put(key + METADATA_CACHE_PATH, json.dumps(metadata),
+                                  expiry=self.metadata_cache_window)
+        return metadata
+
     def is_key_public(self, key):
         ''' Check whether an S3 object key is publicly readable.
         May cache results to reduce API calls.
         '''
+        return self._get_key_visibility(key)[0]
+
+    def _get_key_visibility(self, key):
+        ''' Return a tuple of whether an S3 object key is publicly
+        readable, and whether that is confirmed, ie known from the
+        object itself rather than worked out from its package.
+        '''
         acl_key = key + VISIBILITY_CACHE_PATH
         acl = self.redis.get(acl_key)
         if acl == PUBLIC_ACL:
-            return True
+            return True, True
         if acl == PRIVATE_ACL:
-            return False
-
-        client = self.get_s3_client()
-        # check if the object ACL grants any permission to all users
-        acl = PUBLIC_ACL if any(
-            grant['Grantee']['Type'] == 'Group'
-            and grant['Grantee'].get('URI', '').endswith('AllUsers')
-            for grant in client.get_object_acl(Bucket=self.bucket_name, Key=key)['Grants']
-        ) else PRIVATE_ACL
+            return False, True
+
+        acl = self._resolve_key_acl(key)
+        if acl is not None and not self.verify_acl:
+            # Not cached, since it may be ahead of the object itself
+            # if a visibility update is still in progress.
+            return acl == PUBLIC_ACL, False
+
+        expected_acl = acl
+        acl = self._get_key_acl(key)
+        if expected_acl is not None and (expected_acl == PUBLIC_ACL) != (acl == PUBLIC_ACL):
+            log.warning("Object %s was expected to be %s but is %s", key, expected_acl, acl)
         self.redis.put(acl_key, acl, expiry=self.acl_cache_window)
-        return acl == PUBLIC_ACL
+        return acl == PUBLIC_ACL, True
+
+    def _resolve_key_acl(self, key):
+        ''' Work out the ACL that an object should have without
+        querying S3, or return None if that is not possible.
+        '''
+        return None
 
     def get_signed_url_to_key(self, key, extra_params={}):
         '''Generates a pre-signed URL giving access to an S3 object,
@@ -244,36 +833,102 @@ class BaseS3Uploader(object):
         will fail signature verification; the download_proxy server must
         be configured to set the Host header back to the true value when
         forwarding the request (CloudFront does this automatically).
+
+        Signed URLs are reused for up to signed_url_cache_window seconds.
+        After that, they continue to be served while still valid, and
+        a replacement is generated in the background.
         '''
-        cache_url = self.redis.get(key)
+        cache_url, fresh = self._get_cached_url(key)
         if cache_url:
-            log.debug('Returning cached URL for path %s', key)
+            if not fresh:
+                log.debug('Cached URL for path %s is due for refresh', key)
+                _url_refresher.refresh(
+                    key, lambda: self._regenerate_url(key, extra_params, background=True))
+            else:
+                log.debug('Returning cached URL for path %s', key)
             return cache_url
         else:
             log.debug('No cache found for %s; generating a new URL', key)
 
+        # If many requests miss at once, only one thread per process,
+        # and only one process at a time, does the regeneration.
+        return _url_flights.run(key, lambda: self._regenerate_url(key, extra_params),
+                                recheck=lambda: self._get_cached_url(key)[0])
+
+    def _get_cached_url(self, key):
+        ''' Return a tuple of the cached URL for `key`, or None,
+        and whether it is fresh, ie not yet due to be refreshed.
+        '''
+        cache_value = self.redis.get(key)
+        if not cache_value:
+            return None, False
+        try:
+            cached = json.loads(cache_value)
+            return cached['url'], cached['refresh_at'] > time.time()
+        except (ValueError, TypeError, KeyError):
+            # a plain URL, cached before refresh times were recorded
+            return cache_value, True
+
+    def _cache_url(self, key, url, refresh_after, expiry):
+        ''' Cache a URL until `expiry` seconds from now,
+        to be refreshed once `refresh_after` seconds have passed.
+        '''
+        if refresh_after > 0:
+            self.redis.put(key, json.dumps({'url': url, 'refresh_at': time.time() + refresh_after}),
+                           expiry=max(expiry, refresh_after))
+
+    def _regenerate_url(self, key, extra_params, background=False):
+        lock_key = key + URL_LOCK_PATH
+        token = self.redis.acquire_lock(lock_key, URL_LOCK_EXPIRY)
+        try:
+            if token is None:
+                if background:
+                    log.debug('URL for %s is being refreshed elsewhere', key)
+                    return None
+                # wait for the URL, or for the lock to be released or expire
+                log.debug('URL for %s is being generated elsewhere; waiting', key)
+                # the lock has certainly expired by this time
+                deadline = time.time() + URL_LOCK_EXPIRY + 1
+                while token is None:
+                    if time.time() >= deadline:
+                        log.warning('Timed out waiting for URL for %s; generating it anyway', key)
+                        break
+                    time.sleep(URL_WAIT_INTERVAL)
+                    cache_url, fresh = self._get_cached_url(key)
+                    if cache_url:
+                        return cache_url
+                    token = self.redis.acquire_lock(lock_key, URL_LOCK_EXPIRY)
+            if token is not None:
+                # another process may have finished just before we took the lock
+                cache_url, fresh = self._get_cached_url(key)
+                if fresh:
+                    return cache_url
+            return self._generate_url(key, extra_params)
+        finally:
+            if token is not None:
+                self.redis.release_lock(lock_key, token)
+
+    def _generate_url(self, key, extra_params):
         client = self.get_s3_client()
 
         # check whether the object exists in S3
         log.debug('Checking that S3 object %s exists', key)
         try:
-            metadata = client.head_object(Bucket=self.bucket_name, Key=key)
+            metadata = self.get_key_metadata(key, client)
         except ClientError:
             log.warning("Key '%s' not found in bucket '%s'",
                         key, self.bucket_name)
             raise toolkit.ObjectNotFound("Unable to retrieve metadata for object [{}]".format(key))
 
         # check whether the object is publicly readable
-        is_public_read = self.is_key_public(key)
-        params = {'Bucket': self.bucket_name,
-                  'Key': key}
+        is_public_read, acl_confirmed = self._get_key_visibility(key)
+        params = {}
         if not is_public_read and metadata['ContentType'] != 'application/pdf':
             filename = key.split('/')[-1]
             params['ResponseContentDisposition'] = 'attachment; filename=' + filename
         params.update(extra_params)
-        url = client.generate_presigned_url(ClientMethod='get_object',
-                                            Params=params,
-                                            ExpiresIn=self.signed_url_expiry)
+        url = presigner.generate_presigned_url(
+            client, self.bucket_name, key, self.signed_url_expiry, params)
         if self.download_proxy:
             url = URL_HOST.sub(self.download_proxy + '/', url, 1)
 
@@ -283,11 +938,19 @@ class BaseS3Uploader(object):
             if hasattr(six, 'ensure_text'):
                 data = six.ensure_text(data)
             url = url.split('?')[0] + '?' + data
-            cache_expiry = self.public_url_cache_window
+            if acl_confirmed:
+                # an unsigned URL does not expire, so keep serving it
+                # while a replacement is generated in the background
+                self._cache_url(key, url, self.public_url_cache_window,
+                                self.public_url_cache_window * PUBLIC_URL_EXPIRY_FACTOR)
+            else:
+                # the object may not be public yet, so check again soon
+                cache_window = min(self.public_url_cache_window, self.signed_url_cache_window)
+                self._cache_url(key, url, cache_window, cache_window)
         else:
-            cache_expiry = self.signed_url_cache_window
-
-        self.redis.put(key, url, expiry=cache_expiry)
+            # keep serving the URL until shortly before it expires
+            self._cache_url(key, url, self.signed_url_cache_window,
+                            self.signed_url_expiry - SIGNED_URL_MIN_VALIDITY)
         return url
 
     def as_clean_dict(self, dict):
@@ -328,7 +991,7 @@ class S3Uploader(BaseS3Uploader):
 
     @classmethod
     def get_storage_path(cls, upload_to):
-        path = config.get('ckanext.s3filestore.aws_storage_path', '')
+        path = get_settings().aws_storage_path
         return os.path.join(path, 'storage', 'uploads', upload_to)
 
     def update_data_dict(self, data_dict, url_field, file_field, clear_field):
@@ -396,7 +1059,7 @@ class S3Uploader(BaseS3Uploader):
         # file to the appropriate key in the AWS bucket.
         if self.filename:
             self.upload_to_key(self.filepath, self.upload_file,
-                               acl=PUBLIC_ACL)
+                               acl=PUBLIC_ACL, max_size=max_size * MB)
             self.clear = True
 
         if (self.clear and self.old_filename
@@ -456,13 +1119,11 @@ class S3Uploader(BaseS3Uploader):
                         filename, self.bucket_name)
 
         try:
-            client = self.get_s3_client()
-
-            metadata = client.head_object(Bucket=self.bucket_name, Key=key_path)
+            metadata = self.get_key_metadata(key_path)
             metadata['content_type'] = metadata['ContentType']
             metadata['size'] = metadata['ContentLength']
             metadata['hash'] = metadata['ETag']
-            return self.as_clean_dict(metadata)
+            return metadata
         except ClientError as ex:
             if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
                 if config.get(
@@ -494,10 +1155,11 @@ class S3ResourceUploader(BaseS3Uploader):
 
         super(S3ResourceUploader, self).__init__()
 
-        self.use_filename = toolkit.asbool(config.get('ckanext.s3filestore.use_filename', False))
-        self.delete_non_current_days = int(config.get('ckanext.s3filestore.delete_non_current_days', '-1'))
-        path = config.get('ckanext.s3filestore.aws_storage_path', '')
-        self.storage_path = os.path.join(path, 'resources')
+        settings = self.settings
+        self.use_filename = settings.use_filename
+        self.delete_non_current_days = settings.delete_non_current_days
+        self.acl_concurrency = settings.acl_concurrency
+        self.storage_path = os.path.join(settings.aws_storage_path, 'resources')
         self.filename = None
         self.old_filename = None
         self.url = resource['url']
@@ -507,8 +1169,6 @@ class S3ResourceUploader(BaseS3Uploader):
         upload_field_storage = resource.pop('upload', None)
         self.clear = resource.pop('clear_upload', None)
 
-        mime = magic.Magic(mime=True)
-
         if isinstance(upload_field_storage, ALLOWED_UPLOAD_TYPES) \
                 and upload_field_storage.filename:
             self.filesize = 0  # bytes
@@ -535,28 +1195,13 @@ class S3ResourceUploader(BaseS3Uploader):
             self.mimetype = resource.get('mimetype')
             if not self.mimetype:
                 try:
-                    try:
-                        # Get type from file extension if we recognise it
-                        self.mimetype = mimetypes.guess_type(self.filename, strict=False)[0]
-                    except Exception:
-                        pass
-                    if not self.mimetype:
-                        try:
-                            # 2048 bytes are needed to detect Office docs
-                            self.mimetype = mime.from_buffer(self.upload_file.read(2048))
-                        except Exception:
-                            pass
-                    resource['mimetype'] = self.mimetype
-
-                    # additional check on text/plain mimetypes for
-                    # more reliable result, if None continue with text/plain
-                    if self.mimetype == 'text/plain':
-                        self.mimetype = resource['mimetype'] = \
-                            mimetypes.guess_type(self.filename, strict=False)[0] or 'text/plain'
-                    # go back to the beginning of the file buffer
-                    self.upload_file.seek(0, os.SEEK_SET)
+                    # Get type from file extension if we recognise it;
+                    # otherwise, it is detected from the content on upload
+                    self.mimetype = mimetypes.guess_type(self.filename, strict=False)[0]
                 except Exception:
                     pass
+                if self.mimetype:
+                    resource['mimetype'] = self.mimetype
         elif self.clear and resource.get('id'):
             # New, not yet created resources can be marked for deletion if the
             # users cancels an upload and enters a URL instead.
@@ -593,6 +1238,40 @@ class S3ResourceUploader(BaseS3Uploader):
         filepath = os.path.join(directory, filename)
         return filepath
 
+    def _resolve_key_acl(self, key):
+        ''' Work out the ACL that an object of this resource should have
+        from the visibility of its package, if the ACL config is 'auto'.
+        Returns None if the object does not belong to this resource,
+        or the package visibility is unknown.
+        '''
+        resource_id = self.resource.get('id')
+        package_id = self.resource.get('package_id')
+        if self.acl != 'auto' or not resource_id or not package_id \
+                or not key.startswith(self.get_directory(resource_id, self.storage_path) + '/'):
+            return None
+        if key != self.get_path(resource_id) and self.non_current_acl != 'auto':
+            return self.non_current_acl
+
+        is_private = self._is_package_private(package_id)
+        if is_private is None:
+            return None
+        return PRIVATE_ACL if is_private else PUBLIC_ACL
+
+    def _is_package_private(self, package_id):
+        ''' Look up whether a package is private, from cache if possible,
+        otherwise from the database. Returns None if it is not found.
+        '''
+        cache_private = self.redis.get(package_id + PACKAGE_PRIVATE_CACHE_PATH)
+        if cache_private in ('True', 'False'):
+            return cache_private == 'True'
+        try:
+            is_private = model.Session.query(model.Package.private) \
+                .filter(model.Package.id == package_id).scalar()
+        except Exception as e:
+            log.warning("Failed to look up visibility of package %s: %s", package_id, e)
+            return None
+        return None if is_private is None else bool(is_private)
+
     def _get_target_acl(self, resource_id):
         if self.acl == 'auto':
             package = self._get_package(resource_id)
@@ -603,62 +1282,135 @@ class S3ResourceUploader(BaseS3Uploader):
     def update_visibility(self, id, target_acl=None):
         ''' Update the visibility of all S3 objects for a resource
         to match the package, if the ACL config is set to 'auto'.
+
+        Objects are listed page by page, and their ACLs are checked and
+        updated concurrently. Returns a Counter of the actions taken;
+        if any object could not be updated, the rest are still
+        processed and then an exception is raised.
         '''
+        from ckanext.s3filestore.visibility import AclReconciler, FAILED
+
         if self.acl != 'auto':
             return
         if not target_acl:
             target_acl = self._get_target_acl(id)
 
-        client = self.get_s3_client()
-
         current_key = self.get_path(id)
         all_visibility = self.redis.get(current_key + VISIBILITY_CACHE_PATH + '/all')
         if all_visibility is not None and all_visibility == target_acl:
             log.debug("update_visibility: id: %s already set and found in cache as %s", id, target_acl)
             return
+
         # iterate through every S3 object matching the resource ID
-        log.debug("update_visibility: id: %s getting item list from store", id)
-        resource_objects = client.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=self.get_directory(id, self.storage_path)
-        )
-        log.debug("update_visibility: id: %s finished item list from store", id)
-        if not resource_objects['KeyCount']:
-            return
+        log.debug("update_visibility: id: %s reconciling objects", id)
+        pages = self.iter_object_pages(self.get_directory(id, self.storage_path))
+        actions = Counter()
+        failures = []
+        for result in AclReconciler(self).reconcile(current_key, target_acl, pages):
+            log.debug("update_visibility: %s %s", result.key, result.action)
+            actions[result.action] += 1
+            if result.action == FAILED:
+                failures.append(result.key)
+        log.debug("update_visibility: id: %s finished reconciling objects: %s", id, dict(actions))
+        if failures:
+            raise S3FileStoreException(
+                "Failed to update visibility of {} of {} objects for resource {}: {}".format(
+                    len(failures), sum(actions.values()), id, ', '.join(failures)))
+        if actions:
+            self.redis.put(current_key + VISIBILITY_CACHE_PATH + '/all', target_acl, expiry=self.acl_cache_window)
+        return actions
+
+    def update_package_visibility(self, resources, target_acl=None):
+        ''' Update the visibility of all S3 objects for several resources,
+        typically every resource in a package, if the ACL config is set
+        to 'auto'.
+
+        The resources share one S3 client, thread pool and Redis pipeline,
+        rather than each being reconciled in turn. Returns a Counter of
+        the actions taken; if any object could not be updated, the rest
+        are still processed and then an exception is raised.
+        '''
+        from ckanext.s3filestore.visibility import FAILED
 
-        for upload in resource_objects['Contents']:
-            upload_key = upload['Key']
-            log.debug("Setting visibility for key [%s], current object is [%s]", upload_key, current_key)
-            if upload_key == current_key:
-                acl = target_acl
-            elif self.delete_non_current_days >= 0 and _get_object_age_days(upload) >= self.delete_non_current_days:
-                self.clear_key(upload_key)
-                continue
-            elif self.non_current_acl == 'auto':
-                acl = target_acl
-            else:
-                acl = self.non_current_acl
-
-            is_public_read = self.is_key_public(upload_key)
-            # if the ACL status doesn't match what we want, update it
-            if (acl == PUBLIC_ACL) != is_public_read:
-                log.debug("Updating ACL for object %s to %s", upload_key, acl)
-                client.put_object_acl(
-                    Bucket=self.bucket_name, Key=upload_key, ACL=acl)
-                # Drop the cached URL since it will likely need to change
-                self.redis.delete(upload_key)
-                self.redis.put(upload_key + VISIBILITY_CACHE_PATH, acl, expiry=self.acl_cache_window)
-        self.redis.put(current_key + VISIBILITY_CACHE_PATH + '/all', target_acl, expiry=self.acl_cache_window)
+        if self.acl != 'auto' or not resources:
+            return
+        if not target_acl:
+            target_acl = self._get_target_acl(resources[0]['id'])
+
+        actions, failed = self.update_resources_visibility(
+            [(resource, target_acl) for resource in resources])
+        if failed:
+            raise S3FileStoreException(
+                "Failed to update visibility of {} objects for resources {}".format(
+                    actions[FAILED], ', '.join(sorted(failed))))
+        return actions
+
+    def update_resources_visibility(self, targets, dry_run=False):
+        ''' Update the visibility of all S3 objects for several resources,
+        each to its own target ACL, in one batch.
+
+        :param targets: a list of (resource dict, target ACL) tuples;
+            each resource dict must contain 'id' and 'url'
+        :param dry_run: if True, report the changes that would be made
+            without making them
+
+        :returns: a tuple of a Counter of the actions taken, and the set
+            of IDs of resources where any object could not be updated
+        '''
+        from ckanext.s3filestore.visibility import AclReconciler, FAILED
+
+        resource_ids = {}
+        reconcile_targets = {}
+        for resource, target_acl in targets:
+            directory = self.get_directory(resource['id'], self.storage_path)
+            resource_ids[directory] = resource['id']
+            reconcile_targets[directory] = (
+                self.get_path(resource['id'], os.path.basename(resource.get('url') or '')),
+                target_acl)
+
+        # skip resources that are already known to be up to date
+        directories = list(reconcile_targets.keys())
+        all_visibility = self.redis.get_many(
+            [reconcile_targets[directory][0] + VISIBILITY_CACHE_PATH + '/all' for directory in directories])
+        for directory, visibility in zip(directories, all_visibility):
+            if visibility == reconcile_targets[directory][1]:
+                del reconcile_targets[directory]
+        log.debug("update_resources_visibility: reconciling %s of %s resources",
+                  len(reconcile_targets), len(resource_ids))
+
+        actions = Counter()
+        reconciled = set()
+        failed = set()
+        reconciler = AclReconciler(self, dry_run=dry_run)
+        for result in reconciler.reconcile_resources(reconcile_targets):
+            log.debug("update_resources_visibility: %s %s", result.key, result.action)
+            actions[result.action] += 1
+            directory = os.path.dirname(result.key)
+            reconciled.add(directory)
+            if result.action == FAILED:
+                failed.add(directory)
+        log.debug("update_resources_visibility: finished reconciling objects: %s", dict(actions))
+
+        if not dry_run:
+            with self.redis.batch() as cache:
+                for directory in reconciled - failed:
+                    current_key, target_acl = reconcile_targets[directory]
+                    cache.put(current_key + VISIBILITY_CACHE_PATH + '/all', target_acl,
+                              expiry=self.acl_cache_window)
+        return actions, set(resource_ids[directory] for directory in failed)
 
     def upload(self, id, max_size=10):
-        '''Upload the file to S3.'''
+        '''Upload the file to S3. max_size is the maximum size
+        of the file in MB.'''
 
         # If a filename has been provided (a file is being uploaded) write the
         # file to the appropriate key in the AWS bucket.
         if self.filename:
             filepath = self.get_path(id, self.filename)
-            self.upload_to_key(filepath, self.upload_file, acl=self._get_target_acl(id),
-                               extra_metadata=self._get_resource_metadata())
+            reader = self.upload_to_key(filepath, self.upload_file, acl=self._get_target_acl(id),
+                                        extra_metadata=self._get_resource_metadata(),
+                                        max_size=max_size * MB)
+            self._record_upload(id, reader)
             self.update_visibility(id)
 
         # The resource form only sets self.clear (via the input clear_upload)
@@ -670,6 +1422,37 @@ class S3ResourceUploader(BaseS3Uploader):
             filepath = self.get_path(id, self.old_filename)
             self.clear_key(filepath)
 
+    def _get_upload_mimetype(self, head):
+        ''' Detect the content type from the first chunk of the upload,
+        if it was not given and could not be guessed from the filename.
+        '''
+        if not getattr(self, 'mimetype', None):
+            try:
+                # 2048 bytes are needed to detect Office docs
+                self.mimetype = _mime_detector.from_buffer(head[:2048])
+            except Exception:
+                pass
+            if self.mimetype:
+                self.resource['mimetype'] = self.mimetype
+        return super(S3ResourceUploader, self)._get_upload_mimetype(head)
+
+    def _record_upload(self, id, reader):
+        ''' Record the hash, size and detected content type of an
+        uploaded file on the resource.
+
+        CKAN uploads files after saving the resource but before
+        committing, so the changes are committed along with it.
+        '''
+        self.resource['hash'] = reader.sha256
+        self.resource['size'] = reader.size
+        resource_obj = model.Resource.get(id)
+        if resource_obj is None:
+            return
+        resource_obj.hash = reader.sha256
+        resource_obj.size = reader.size
+        if getattr(self, 'mimetype', None) and not resource_obj.mimetype:
+            resource_obj.mimetype = self.mimetype
+
     def _get_resource_metadata(self):
         ''' Retrieve a dict of metadata about the resource,
         to be added to the S3 object.
@@ -683,6 +1466,155 @@ class S3ResourceUploader(BaseS3Uploader):
         metadata['uploaded_by'] = ensure_ascii(username)
         return metadata
 
+    def presign_upload(self, id, filename, content_type=None, max_size=None,
+                       size=None, method='POST'):
+        ''' Return what a client needs to upload a file for the resource
+        straight to S3, to the key that `upload` would use and with the
+        same ACL, content type and metadata.
+
+        For 'POST', the result holds the 'url' and form 'fields' of a
+        presigned POST, whose policy limits the file to `max_size` bytes.
+        For 'PUT', `size` must be given, and the result holds the 'url'
+        and the 'headers' that must be sent with it; S3 rejects the
+        upload if any of them, or the length, do not match.
+        '''
+        filepath = self.get_path(id, filename)
+        if not content_type:
+            content_type = mimetypes.guess_type(filepath, strict=False)[0] or 'application/octet-stream'
+        object_args = self._get_object_args(
+            filepath, self._get_target_acl(id), content_type, self._get_resource_metadata())
+        expires_in = self.settings.upload_url_expiry
+        client = self.get_s3_client()
+
+        if method == 'PUT':
+            params = dict(object_args, Bucket=self.bucket_name, Key=filepath, ContentLength=size)
+            return {
+                'method': 'PUT',
+                'url': client.generate_presigned_url(
+                    'put_object', Params=params, ExpiresIn=expires_in),
+                'headers': _get_upload_fields(object_args, 'x-amz-acl'),
+                'key': filepath,
+                'expires_in': expires_in,
+            }
+
+        fields = _get_upload_fields(object_args, 'acl')
+        conditions = [{name: value} for name, value in six.iteritems(fields)]
+        if max_size is not None:
+            conditions.append(['content-length-range', 0, max_size])
+        post = client.generate_presigned_post(
+            self.bucket_name, filepath, Fields=fields, Conditions=conditions, ExpiresIn=expires_in)
+        return {
+            'method': 'POST',
+            'url': post['url'],
+            'fields': post['fields'],
+            'key': filepath,
+            'expires_in': expires_in,
+        }
+
+    def finalize_upload(self, id, filename, max_size=None):
+        ''' Check that a file uploaded with `presign_upload` has arrived,
+        and drop anything cached about the key from before the upload.
+
+        Raises ValidationError if the object is missing, or if it is
+        larger than `max_size` bytes, in which case it is deleted.
+        Otherwise, returns its metadata as from `get_key_metadata`.
+        '''
+        filepath = self.get_path(id, filename)
+        self.redis.delete_many([filepath, filepath + VISIBILITY_CACHE_PATH,
+                                filepath + VISIBILITY_CACHE_PATH + '/all',
+                                filepath + METADATA_CACHE_PATH])
+        try:
+            metadata = self.get_key_metadata(filepath)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                raise toolkit.ValidationError({'upload': ['File has not been uploaded']})
+            raise e
+        if max_size is not None and metadata['ContentLength'] > max_size:
+            log.info("Rejected upload to [%s]: %s bytes exceeds the limit of %s bytes",
+                     filepath, metadata['ContentLength'], max_size)
+            self.clear_key(filepath)
+            raise toolkit.ValidationError({'upload': ['File upload too large']})
+        return metadata
+
+    def start_multipart_upload(self, id, filename, content_type=None, size=None):
+        ''' Start a multipart upload of a file for the resource, to the
+        key that `upload` would use and with the same ACL, content type
+        and metadata. The client then uploads the parts itself, using
+        `presign_upload_parts`.
+
+        Returns the 'upload_id' and 'key', and the suggested 'part_size',
+        which is large enough for `size` bytes to fit if it is given.
+        '''
+        filepath = self.get_path(id, filename)
+        if not content_type:
+            content_type = mimetypes.guess_type(filepath, strict=False)[0] or 'application/octet-stream'
+        response = self.get_s3_client().create_multipart_upload(
+            Bucket=self.bucket_name, Key=filepath, **self._get_object_args(
+                filepath, self._get_target_acl(id), content_type, self._get_resource_metadata()))
+        log.debug("Started client multipart upload %s of %s", response['UploadId'], filepath)
+        return {
+            'upload_id': response['UploadId'],
+            'key': filepath,
+            'part_size': max(self.multipart_part_size, MIN_PART_SIZE, -(-(size or 0) // MAX_PARTS)),
+        }
+
+    def presign_upload_parts(self, id, filename, upload_id, part_numbers):
+        ''' Return a dict of part numbers to presigned URLs,
+        to which the client can PUT the parts of a multipart upload.
+        '''
+        filepath = self.get_path(id, filename)
+        expires_in = self.settings.upload_url_expiry
+        client = self.get_s3_client()
+        return {
+            part_number: client.generate_presigned_url('upload_part', Params={
+                'Bucket': self.bucket_name, 'Key': filepath,
+                'UploadId': upload_id, 'PartNumber': part_number,
+            }, ExpiresIn=expires_in)
+            for part_number in part_numbers
+        }
+
+    def list_upload_parts(self, id, filename, upload_id):
+        ''' Return the parts of a multipart upload that S3 has received,
+        in order, each as a dict of 'PartNumber', 'ETag' and 'Size'.
+        '''
+        filepath = self.get_path(id, filename)
+        paginator = self.get_s3_client().get_paginator('list_parts')
+        return [
+            {'PartNumber': part['PartNumber'], 'ETag': part['ETag'], 'Size': part['Size']}
+            for page in paginator.paginate(Bucket=self.bucket_name, Key=filepath, UploadId=upload_id)
+            for part in page.get('Parts', [])
+        ]
+
+    def complete_multipart_upload(self, id, filename, upload_id, max_size=None):
+        ''' Assemble the parts of a multipart upload that S3 has received
+        into the object, and check it as `finalize_upload` does.
+
+        If the parts add up to more than `max_size` bytes, the upload
+        is aborted and a ValidationError raised.
+        '''
+        filepath = self.get_path(id, filename)
+        parts = self.list_upload_parts(id, filename, upload_id)
+        if not parts:
+            raise toolkit.ValidationError({'upload': ['File has not been uploaded']})
+        if max_size is not None and sum(part['Size'] for part in parts) > max_size:
+            self.abort_multipart_upload(id, filename, upload_id)
+            raise toolkit.ValidationError({'upload': ['File upload too large']})
+        self.get_s3_client().complete_multipart_upload(
+            Bucket=self.bucket_name, Key=filepath, UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in parts]})
+        log.debug("Completed client multipart upload %s of %s in %s parts",
+                  upload_id, filepath, len(parts))
+        return self.finalize_upload(id, filename, max_size)
+
+    def abort_multipart_upload(self, id, filename, upload_id):
+        ''' Abort a multipart upload, so that S3 discards its parts.
+        '''
+        filepath = self.get_path(id, filename)
+        log.info("Aborting client multipart upload %s of %s", upload_id, filepath)
+        self.get_s3_client().abort_multipart_upload(
+            Bucket=self.bucket_name, Key=filepath, UploadId=upload_id)
+
     def delete(self, id, filename=None):
         ''' Delete file we are pointing at'''
 
@@ -747,26 +1679,12 @@ class S3ResourceUploader(BaseS3Uploader):
                         filename, self.bucket_name)
 
         try:
-            # Small workaround to manage downloading of large files
-            # We are using redirect to minio's resource public URL
-            client = self.get_s3_client()
-
-            metadata = client.head_object(Bucket=self.bucket_name, Key=key_path)
+            # Only public metadata is cached, so nothing needs to be dropped
+            metadata = self.get_key_metadata(key_path)
             metadata['content_type'] = metadata['ContentType']
-
-            # Drop non public metadata
-            metadata.pop('ServerSideEncryption', None)
-            metadata.pop('SSECustomerAlgorithm', None)
-            metadata.pop('SSECustomerKeyMD5', None)
-            metadata.pop('SSEKMSKeyId', None)
-            metadata.pop('StorageClass', None)
-            metadata.pop('RequestCharged', None)
-            metadata.pop('ReplicationStatus', None)
-            metadata.pop('ObjectLockLegalHoldStatus', None)
-
             metadata['size'] = metadata['ContentLength']
             metadata['hash'] = metadata['ETag']
-            return self.as_clean_dict(metadata)
+            return metadata
         except ClientError as ex:
             if ex.response['Error']['Code'] in ['NoSuchKey', '404']:
                 if config.get(
@@ -1,23 +1,105 @@
 # encoding: utf-8
 
+import json
 import logging
 import os
 
-
 from botocore.exceptions import ClientError
 
 from ckan import model
 from ckan.common import request
+from ckan.lib.dictization import model_dictize
+from ckan.plugins import PluginImplementations, IResourceController
 
 from ckanext.s3filestore import uploader
 from ckan.lib.uploader import ResourceUpload as DefaultResourceUpload
-from ckan.plugins.toolkit import abort, _, g, get_action, \
-    NotAuthorized, ObjectNotFound, redirect_to
+from ckan.plugins.toolkit import abort, _, check_access, check_ckan_version, config, g, \
+    get_action, NotAuthorized, ObjectNotFound, redirect_to
 
-from ckanext.s3filestore.uploader import S3Uploader, BaseS3Uploader
+from ckanext.s3filestore.redis_helper import RedisHelper
+from ckanext.s3filestore.uploader import S3Uploader, BaseS3Uploader, DOWNLOAD_CACHE_PATH
 
 log = logging.getLogger(__name__)
 
+DEFAULT_DOWNLOAD_AUTH_CACHE_WINDOW = 60
+
+
+def _get_downloadable_resource(context, package_id, resource_id):
+    '''
+    Return the resource fields needed for a download, if the resource
+    belongs to the package and the current user may see it.
+
+    Rather than serialising the whole dataset with 'package_show',
+    this loads only the needed columns and calls the 'resource_show'
+    auth function. Both are cached for a short time; the resource
+    fields until the package or resource is next updated or deleted,
+    and the authorisation per user.
+
+    If other plugins implement IResourceController, the resource is
+    dictized and passed through their show hooks on every request,
+    as 'resource_show' would do.
+    '''
+    cache_window = int(config.get(
+        'ckanext.s3filestore.download_auth_cache_window', DEFAULT_DOWNLOAD_AUTH_CACHE_WINDOW))
+    redis = RedisHelper()
+    resource_cache_key = resource_id + DOWNLOAD_CACHE_PATH
+
+    rsc = None
+    if cache_window > 0:
+        cache_value = redis.get(resource_cache_key)
+        if cache_value:
+            rsc = json.loads(cache_value)
+    if rsc is None:
+        row = model.Session.query(
+            model.Resource.id, model.Resource.url, model.Resource.url_type,
+            model.Package.id, model.Package.name, model.Package.metadata_modified,
+            model.Package.state
+        ).join(model.Package, model.Package.id == model.Resource.package_id) \
+            .filter(model.Resource.id == resource_id,
+                    model.Resource.state == u'active').first()
+        if row is None:
+            raise ObjectNotFound(_(u'Resource not found'))
+        rsc = {
+            u'id': row[0], u'url': row[1], u'url_type': row[2],
+            u'package_id': row[3], u'package_name': row[4],
+            # changes whenever the package is updated or deleted
+            u'version': u'{0}/{1}'.format(row[5].isoformat() if row[5] else u'', row[6]),
+        }
+        if cache_window > 0:
+            redis.put(resource_cache_key, json.dumps(rsc), expiry=cache_window)
+
+    if package_id not in (rsc[u'package_id'], rsc[u'package_name']):
+        raise ObjectNotFound(_(u'Resource not found'))
+
+    auth_cache_key = u'{0}/{1}/{2}'.format(
+        resource_cache_key, rsc[u'version'], context.get(u'user') or u'')
+    if cache_window <= 0 or redis.get(auth_cache_key) != u'True':
+        check_access(u'resource_show', context, {u'id': resource_id})
+        if cache_window > 0:
+            redis.put(auth_cache_key, u'True', expiry=cache_window)
+    return _apply_show_hooks(context, rsc)
+
+
+def _apply_show_hooks(context, rsc):
+    '''
+    Pass the resource through the IResourceController show hooks
+    of other plugins, if there are any.
+    '''
+    from ckanext.s3filestore.plugin import S3FileStorePlugin
+
+    hook_name = 'before_resource_show' if check_ckan_version('2.10') else 'before_show'
+    hooks = [getattr(plugin, hook_name) for plugin in PluginImplementations(IResourceController)
+             if not isinstance(plugin, S3FileStorePlugin)]
+    if not hooks:
+        return rsc
+    resource = model.Resource.get(rsc[u'id'])
+    if resource is None or resource.state != u'active':
+        raise ObjectNotFound(_(u'Resource not found'))
+    resource_dict = model_dictize.resource_dictize(resource, context)
+    for hook in hooks:
+        resource_dict = hook(resource_dict)
+    return dict(resource_dict, package_name=rsc[u'package_name'])
+
 
 def resource_download(package_type, id, resource_id, filename=None):
     '''
@@ -30,14 +112,13 @@ def resource_download(package_type, id, resource_id, filename=None):
                u'auth_user_obj': g.userobj}
 
     try:
-        rsc = get_action(u'resource_show')(context, {'id': resource_id})
-        get_action(u'package_show')(context, {u'id': id})
+        rsc = _get_downloadable_resource(context, id, resource_id)
 
         if rsc.get('url_type') == 'upload':
             upload = uploader.S3ResourceUploader(rsc)
             return upload.download(rsc['id'], filename)
 
-        elif u'url' not in rsc:
+        elif not rsc.get(u'url'):
             return abort(404, _(u'No download is available'))
 
         # if we're trying to download a link resource, just redirect to it
@@ -0,0 +1,194 @@
+# encoding: utf-8
+
+import logging
+from collections import deque, namedtuple
+import six
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ckanext.s3filestore.uploader import PUBLIC_ACL, PRIVATE_ACL, \
+    DELETE_OBJECTS_BATCH_SIZE, VISIBILITY_CACHE_PATH, _get_object_age_days
+
+log = logging.getLogger(__name__)
+
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+DELETED = 'deleted'
+FAILED = 'failed'
+
+# The outcome of reconciling one S3 object.
+# 'action' is one of UNCHANGED, UPDATED, DELETED or FAILED;
+# 'acl' is the ACL the object should have, or None if it was
+# to be deleted; 'error' is the exception if the action failed.
+AclResult = namedtuple('AclResult', ['key', 'action', 'acl', 'error'])
+
+
+class AclReconciler(object):
+    ''' Brings the ACLs of S3 objects in line with their targets.
+
+    ACL lookups and changes are made on a thread pool of at most
+    'max_workers' threads, sharing the uploader's pooled S3 client.
+    Cache updates are collected and sent to Redis in one pipeline.
+    Expired objects are collected and deleted in batches of up to
+    DELETE_OBJECTS_BATCH_SIZE keys per request.
+
+    Each object is reported with an AclResult; a failure on one
+    object does not prevent the others from being processed.
+    '''
+
+    def __init__(self, uploader, max_workers=None, dry_run=False):
+        self.uploader = uploader
+        self.client = uploader.get_s3_client()
+        self.max_workers = max(max_workers or uploader.acl_concurrency, 1)
+        # if True, report what would be changed without changing it
+        self.dry_run = dry_run
+
+    def reconcile(self, current_key, target_acl, pages):
+        ''' Reconcile the S3 objects belonging to a single resource.
+
+        Pages are consumed lazily. Work on each page is started as soon
+        as it arrives, and the next page is fetched while that work
+        is in progress, so at most two pages are held in memory.
+
+        :param current_key: the key of the current upload
+        :param target_acl: the ACL that the current upload should have
+        :param pages: an iterable of lists of objects, as returned
+            in the 'Contents' of 'list_objects_v2'
+
+        :returns: a generator of AclResult, in listing order,
+            except that deletions are reported once their batch is sent
+        '''
+        return self._reconcile_pages(
+            (current_key, target_acl, uploads) for uploads in pages)
+
+    def reconcile_resources(self, targets):
+        ''' Reconcile the S3 objects of several resources in one pass,
+        eg every resource in a package.
+
+        Resource directories are listed concurrently, a few ahead of
+        the ACL work, and all ACL changes share one thread pool and
+        one Redis pipeline.
+
+        :param targets: a dict of resource directories, ie S3 key
+            prefixes, to a tuple of the key of the current upload in
+            that directory and the ACL that it should have
+
+        :returns: a generator of AclResult
+        '''
+        return self._reconcile_pages(self._list_directories(targets))
+
+    def _list_directories(self, targets):
+        def list_directory(directory):
+            return list(self.uploader.iter_object_pages(directory + '/', self.client))
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            pending = deque()
+            for directory, target in six.iteritems(targets):
+                pending.append((target, executor.submit(list_directory, directory)))
+                if len(pending) < self.max_workers:
+                    continue
+                (current_key, target_acl), future = pending.popleft()
+                for uploads in future.result():
+                    yield current_key, target_acl, uploads
+            while pending:
+                (current_key, target_acl), future = pending.popleft()
+                for uploads in future.result():
+                    yield current_key, target_acl, uploads
+        finally:
+            executor.shutdown(wait=True)
+
+    def _reconcile_pages(self, pages):
+        redis = self.uploader.redis
+        expired = []
+        with redis.batch() as cache:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            try:
+                previous_page = []
+                for current_key, target_acl, uploads in pages:
+                    cached_acls = redis.get_many(
+                        [upload['Key'] + VISIBILITY_CACHE_PATH for upload in uploads])
+                    current_page = [
+                        executor.submit(self._reconcile_object, upload, current_key,
+                                        target_acl, cached_acl, cache)
+                        for upload, cached_acl in zip(uploads, cached_acls)
+                    ]
+                    for result in self._collect_results(previous_page, expired, cache):
+                        yield result
+                    cache.execute()
+                    previous_page = current_page
+                for result in self._collect_results(previous_page, expired, cache, flush=True):
+                    yield result
+            finally:
+                executor.shutdown(wait=True)
+
+    def _collect_results(self, futures, expired, cache, flush=False):
+        ''' Report the results of a page, holding back objects
+        that are to be deleted until a full batch of them is ready,
+        or until the end if `flush` is set.
+        '''
+        for future in futures:
+            result = future.result()
+            if result.action == DELETED and not self.dry_run:
+                expired.append(result.key)
+            else:
+                yield result
+        while len(expired) >= DELETE_OBJECTS_BATCH_SIZE or (flush and expired):
+            keys = expired[:DELETE_OBJECTS_BATCH_SIZE]
+            del expired[:DELETE_OBJECTS_BATCH_SIZE]
+            failures = self.uploader.clear_keys(keys, cache=cache, client=self.client)
+            for key in keys:
+                if key in failures:
+                    yield AclResult(key, FAILED, None, failures[key])
+                else:
+                    yield AclResult(key, DELETED, None, None)
+
+    def get_desired_acl(self, upload, current_key, target_acl):
+        ''' Determine the ACL that an object should have,
+        or None if it should be deleted.
+        '''
+        uploader = self.uploader
+        if upload['Key'] == current_key:
+            return target_acl
+        if uploader.delete_non_current_days >= 0 \
+                and _get_object_age_days(upload) >= uploader.delete_non_current_days:
+            return None
+        if uploader.non_current_acl == 'auto':
+            return target_acl
+        return uploader.non_current_acl
+
+    def _reconcile_object(self, upload, current_key, target_acl, cached_acl, cache):
+        uploader = self.uploader
+        upload_key = upload['Key']
+        acl = self.get_desired_acl(upload, current_key, target_acl)
+        log.debug("Setting visibility for key [%s] to [%s], current object is [%s]",
+                  upload_key, acl, current_key)
+        try:
+            if acl is None:
+                # deleted later, in a batch with other expired objects
+                return AclResult(upload_key, DELETED, acl, None)
+
+            if cached_acl in (PUBLIC_ACL, PRIVATE_ACL):
+                current_acl = cached_acl
+            else:
+                current_acl = uploader._get_key_acl(upload_key, self.client)
+                if not self.dry_run:
+                    cache.put(upload_key + VISIBILITY_CACHE_PATH, current_acl,
+                              expiry=uploader.acl_cache_window)
+
+            # if the ACL status doesn't match what we want, update it
+            if (acl == PUBLIC_ACL) == (current_acl == PUBLIC_ACL):
+                return AclResult(upload_key, UNCHANGED, acl, None)
+            if self.dry_run:
+                return AclResult(upload_key, UPDATED, acl, None)
+            log.debug("Updating ACL for object %s to %s", upload_key, acl)
+            self.client.put_object_acl(
+                Bucket=uploader.bucket_name, Key=upload_key, ACL=acl)
+            # Drop the cached URL since it will likely need to change
+            cache.delete(upload_key)
+            cache.put(upload_key + VISIBILITY_CACHE_PATH, acl,
+                      expiry=uploader.acl_cache_window)
+            return AclResult(upload_key, UPDATED, acl, None)
+        except Exception as e:
+            log.error("Failed to set visibility of %s to %s: %s", upload_key, acl, e)
+            return AclResult(upload_key, FAILED, acl, e)
@@ -0,0 +1,56 @@
+'''
+This script compares the speed of generating presigned GetObject URLs
+with botocore and with the extension's local presigner.
+
+It requires boto3, and does not contact S3. Run it from the root of
+the repository, eg:
+
+    python scripts/benchmark_presigner.py 20000
+
+'''
+
+import os
+import sys
+import timeit
+
+import boto3
+from botocore.client import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ckanext.s3filestore.presigner import S3Presigner  # noqa: E402
+
+BUCKET = 'my-bucket'
+KEY = 'my-path/resources/165900ba-3c60-43c5-9e9c-9f8acd0aa93f/data.csv'
+PARAMS = {'ResponseContentDisposition': 'attachment; filename=data.csv'}
+EXPIRY = 3600
+
+
+def main(iterations):
+    session = boto3.session.Session(
+        aws_access_key_id='AKIDEXAMPLE', aws_secret_access_key='example-secret',
+        region_name='ap-southeast-2')
+    client = session.client('s3', config=Config(
+        signature_version='s3v4', s3={'addressing_style': 'path'}))
+    presigner = S3Presigner()
+    botocore_params = dict(PARAMS, Bucket=BUCKET, Key=KEY)
+
+    def with_botocore():
+        client.generate_presigned_url(
+            ClientMethod='get_object', Params=botocore_params, ExpiresIn=EXPIRY)
+
+    def with_presigner():
+        presigner.generate_presigned_url(client, BUCKET, KEY, EXPIRY, PARAMS)
+
+    # warm up both, so one-off setup is not counted
+    with_botocore()
+    with_presigner()
+
+    botocore_time = min(timeit.repeat(with_botocore, number=iterations, repeat=3))
+    presigner_time = min(timeit.repeat(with_presigner, number=iterations, repeat=3))
+    print('botocore:  {0:8.1f} us per URL'.format(botocore_time / iterations * 1e6))
+    print('presigner: {0:8.1f} us per URL'.format(presigner_time / iterations * 1e6))
+    print('speedup:   {0:8.1f}x'.format(botocore_time / presigner_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)